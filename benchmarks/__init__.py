@@ -0,0 +1,54 @@
+"""
+Benchmarks for the hot paths of m.a.c.h. Run all of them with::
+
+   $ python -m benchmarks --output results.json
+
+Each benchmark is a generator registered with :func:`benchmark`. It
+yields ``(params, func)`` pairs, ``func`` is timed without arguments.
+"""
+import timeit
+
+BENCHMARKS = {}
+
+
+def benchmark(gen):
+    """register a benchmark under the name of the generator"""
+    BENCHMARKS[gen.__name__] = gen
+    return gen
+
+
+def measure(func, repeat=5, quick=False):
+    """return the best time of one call of ``func`` in seconds"""
+    timer = timeit.Timer(func)
+    if quick:
+        return min(timer.repeat(repeat=1, number=1))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(names=None, quick=False):
+    """
+    Run the benchmarks.
+
+    Args:
+        names (list): run only the benchmarks whose names contain one
+        of these strings.
+        quick (bool): time a single call, to check that the benchmarks
+        work.
+
+    Returns:
+        a list of results, one dict for every set of parameters.
+    """
+    # the benchmarks register themselves when imported
+    from benchmarks import build, dispatch, docs  # noqa: F401
+
+    results = []
+    for name, gen in sorted(BENCHMARKS.items()):
+        if names and not any(n in name for n in names):
+            continue
+        for params, func in gen():
+            seconds = measure(func, quick=quick)
+            results.append({'benchmark': name, 'params': params,
+                            'seconds': seconds,
+                            'ops_per_second': 1 / seconds})
+    return results
@@ -0,0 +1,36 @@
+"""Run the benchmarks and write the results as JSON"""
+import argparse
+import json
+import platform
+import sys
+
+import mach
+
+from benchmarks import run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("-k", dest="names", action="append",
+                        help="run only benchmarks whose name contains K")
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'),
+                        default=sys.stdout, help="write the results here")
+    parser.add_argument("--quick", action="store_true",
+                        help="time a single call of every benchmark")
+    opts = parser.parse_args(argv)
+
+    results = run(opts.names, quick=opts.quick)
+    json.dump({'mach': mach.__version__,
+               'python': platform.python_version(),
+               'implementation': platform.python_implementation(),
+               'results': results}, opts.output, indent=2)
+    opts.output.write("\n")
+
+    for result in results:
+        sys.stderr.write("%-20s %-60s %12.0f ops/s\n" % (
+            result['benchmark'], json.dumps(result['params']),
+            result['ops_per_second']))
+
+
+if __name__ == '__main__':
+    main()
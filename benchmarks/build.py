@@ -0,0 +1,93 @@
+"""Building the interface of a class and running one command"""
+import io
+
+from contextlib import redirect_stdout
+
+import mach
+
+from benchmarks import benchmark
+
+
+# the first letters of the options must differ, -h is taken by --help
+LETTERS = "abcdefgijklmnopqrstuvwxyz"
+
+
+def make_class(methods, args):
+    """create a class with ``methods`` methods of ``args`` arguments"""
+    names = ["%sarg" % LETTERS[i] for i in range(args)]
+    params = ", ".join("%s: int=%d" % (name, i)
+                       for i, name in enumerate(names))
+    lines = "\n".join("    %s - argument number %d" % (name, i)
+                      for i, name in enumerate(names))
+    ns = {}
+    for m in range(methods):
+        exec('def cmd%d(self, %s):\n'
+             '    """command number %d\n\n%s\n    """\n' % (
+                 m, params, m, lines), ns)
+    return type('Commands', (), {k: v for k, v in ns.items()
+                                 if k.startswith('cmd')})
+
+
+def build_cold(kls):
+    """build ``kls`` like the first time, without the memoised docstrings"""
+    mach.clear_cache()
+    return mach._mach(kls)
+
+
+@benchmark
+def build():
+    """register the commands, their parsers are built when selected"""
+    for methods in (10, 100, 300):
+        for args in (1, 5, 20):
+            kls = make_class(methods, args)
+            yield ({'methods': methods, 'args': args},
+                   lambda kls=kls: build_cold(kls))
+
+
+@benchmark
+def build_parsers():
+    """build the parsers of all the commands, e.g. for --help"""
+    for methods in (10, 100):
+        for args in (1, 5, 20):
+            kls = make_class(methods, args)
+            yield ({'methods': methods, 'args': args},
+                   lambda kls=kls: build_cold(
+                       kls).parser.subcommands.choices.values())
+
+
+@benchmark
+def build_and_parse():
+    for methods in (10, 100, 300):
+        kls = make_class(methods, 5)
+        yield ({'methods': methods, 'args': 5},
+               lambda kls=kls: build_cold(kls).parser.parse_args(
+                   ['cmd0', '--barg', '3']))
+
+
+@mach.mach1()
+class Calculator:
+
+    def add(self, a: int, b: int):
+        """add two numbers"""
+        print(a + b)
+
+    def connect(self, host: str, port: int=21, **opts):
+        """connect to a host"""
+        print(host, port, opts)
+
+
+def run1(argv, cold):
+    with redirect_stdout(io.StringIO()):
+        if cold:
+            mach.clear_cache(Calculator)
+        Calculator().run(argv)
+
+
+@benchmark
+def run1_invocation():
+    for argv in (['add', '1', '2'],
+                 ['connect', 'example.com', '--port', '2121'],
+                 ['connect', 'example.com', '--opts', '{"user": "oz123"}']):
+        for cold in (False, True):
+            yield ({'argv': " ".join(argv), 'cold': cold},
+                   lambda argv=argv, cold=cold: run1(argv, cold))
@@ -0,0 +1,56 @@
+"""Dispatching shell lines and parsing argument vectors"""
+import argparse
+import io
+
+from mach import DefaultSubcommandArgParse, mach2
+
+from benchmarks import benchmark
+
+
+@mach2()
+class Shell:
+
+    def add(self, a: int, b: int):
+        """add two numbers"""
+        return None
+
+    def connect(self, host: str, port: int=21, **opts):
+        """connect to a host"""
+        return None
+
+
+LINES = {
+    'positional': 'add 1 2',
+    'keyword': 'connect example.com port=2121',
+    'json': 'connect example.com opts=\'{"user": "oz123"}\'',
+}
+
+
+@benchmark
+def onecmd():
+    shell = Shell(stdout=io.StringIO())
+    for kind, line in LINES.items():
+        yield {'line': kind}, lambda line=line: shell.onecmd(line)
+
+
+def make_parser(parser_class, default):
+    parser = parser_class()
+    parser.add_argument("-v", "--verbosity")
+    subparsers = parser.add_subparsers(dest="cmd")
+    for name in ("greet", "part", "clone", "pull", "push"):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("--name")
+    if default:
+        parser.set_default_subparser("greet")
+    return parser
+
+
+@benchmark
+def default_subcommand():
+    plain = make_parser(argparse.ArgumentParser, False)
+    default = make_parser(DefaultSubcommandArgParse, True)
+    for parser_name, parser in (('plain', plain), ('default', default)):
+        yield ({'parser': parser_name, 'argv': 'explicit'},
+               lambda p=parser: p.parse_args(['greet', '--name', 'Tom']))
+    yield ({'parser': 'default', 'argv': 'implicit'},
+           lambda: default.parse_args(['--name', 'Tom']))
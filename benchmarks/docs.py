@@ -0,0 +1,17 @@
+"""Parsing the docstrings of the commands"""
+from mach import parse_docs
+
+from benchmarks import benchmark
+
+
+def make_docstring(params):
+    return "Command summary\n\n%s\n---\nA longer description\n" % "\n".join(
+        "param%d - the description of parameter %d" % (i, i)
+        for i in range(params))
+
+
+@benchmark
+def parse_docs_long():
+    for params in (0, 10, 100, 1000):
+        docstring = make_docstring(params)
+        yield {'params': params}, lambda d=docstring: parse_docs(d)
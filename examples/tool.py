@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+This example demonstrates command groups. The commands of a group are
+methods of a class in another module, which is only imported when one
+of its commands is run::
+
+   $ ./examples/tool.py db migrate 3
+   migrating to version 3
+
+   $ ./examples/tool.py db schema show users
+   CREATE TABLE users (...)
+"""
+
+from mach import mach1
+
+
+@mach1()
+class Tool:
+
+    groups = {'db': ('tool_db.Database', 'manage the database')}
+
+    def version(self):
+        """show the version of the tool"""
+        print("tool 0.1")
+
+
+if __name__ == '__main__':
+    Tool().run()
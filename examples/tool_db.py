@@ -0,0 +1,24 @@
+"""
+The ``db`` command group of ``tool.py``. Importing this module is
+expensive in a real tool, so ``tool.py`` only imports it to run
+``tool.py db ...``.
+"""
+
+
+class Database:
+
+    groups = {'schema': __name__ + '.Schema'}
+
+    def migrate(self, version: int):
+        """migrate the database
+
+        version - the version to migrate to
+        """
+        print("migrating to version %d" % version)
+
+
+class Schema:
+
+    def show(self, table: str):
+        """show the schema of a table"""
+        print("CREATE TABLE %s (...)" % table)
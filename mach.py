@@ -16,16 +16,22 @@ along with m.a.c.h.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
-import inspect
-import json
-import re
-import shlex
+import io
+import os
+import sys
+import time
+import types
 
-from cmd import Cmd
+from collections import namedtuple
 from itertools import filterfalse, tee
 
 __version__ = "0.4.2"
 
+# the start of the "startup" phase reported by --timings, which lasts
+# until the first class is built, mostly importing the program
+_imported = time.perf_counter()
+_startup_seconds = None
+
 
 def partition(pred, iterable):
     'Use a predicate to partition entries into false entries and true entries'
@@ -34,80 +40,581 @@ def partition(pred, iterable):
     return list(filterfalse(pred, t1)), list(filter(pred, t2))
 
 
-class DefaultSubcommandArgParse(argparse.ArgumentParser):
+def map_file(path):
+    """
+    Map the file ``path`` in memory, read only. Files which can not be
+    mapped, like pipes and empty files, are read.
+    """
+    import mmap
+    if path == '-':
+        return sys.stdin.buffer.read()
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return f.read()
+
+
+def file_view(path):
+    """the contents of the file ``path`` as a zero-copy ``memoryview``"""
+    return memoryview(map_file(path))
+
+
+def iter_args_file(path):
+    """
+    Yield the lines of the argument file ``path`` one at a time, without
+    reading the whole file into a string.
+    """
+    data = map_file(path)
+    encoding = sys.getfilesystemencoding()
+    errors = sys.getfilesystemencodeerrors()
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b"\n", start)
+        if end < 0:
+            end = size
+        line = data[start:end]
+        start = end + 1
+        yield line.decode(encoding, errors).rstrip("\r")
+
+
+class ArgsFileArgParse(argparse.ArgumentParser):
+    """
+    Expand ``@file`` arguments, reading the file through ``mmap`` one
+    line at a time, when ``fromfile_prefix_chars`` is set.
+    """
+
+    def _read_args_from_files(self, arg_strings):
+        new_arg_strings = []
+        for arg_string in arg_strings:
+            if not arg_string or \
+                    arg_string[0] not in self.fromfile_prefix_chars:
+                new_arg_strings.append(arg_string)
+                continue
+            try:
+                for arg_line in iter_args_file(arg_string[1:]):
+                    for arg in self.convert_arg_line_to_args(arg_line):
+                        if arg and arg[0] in self.fromfile_prefix_chars:
+                            new_arg_strings.extend(
+                                self._read_args_from_files([arg]))
+                        else:
+                            new_arg_strings.append(arg)
+            except OSError as err:
+                self.error(str(err))
+        return new_arg_strings
+
+
+class DefaultSubcommandArgParse(ArgsFileArgParse):
+    """
+    A parser which runs a default subcommand when none is given.
+
+    The names of the subcommands are looked up in the map of the
+    subparsers action, which is kept when the subparsers are added, so
+    detecting the subcommand costs one lookup. Global options may come
+    before the subcommand, the default is inserted after them. Parsers of
+    subcommands are of the same class and can have defaults of their own.
+    """
     # https://stackoverflow.com/a/37593636/492620
     __default_subparser = None
+    _subcommand_names = {}
 
     def set_default_subparser(self, name):
         self.__default_subparser = name
 
+    def add_subparsers(self, **kwargs):
+        action = super(DefaultSubcommandArgParse, self).add_subparsers(
+            **kwargs)
+        # the names and aliases of the subcommands, filled as they are added
+        self._subcommand_names = action._name_parser_map
+        return action
+
+    def _default_index(self, arg_strings):
+        """
+        The index at which to insert the default subcommand, None if a
+        subcommand or help is requested.
+        """
+        options = self._option_string_actions
+        names = self._subcommand_names
+        i, count = 0, len(arg_strings)
+        while i < count:
+            arg = arg_strings[i]
+            if not arg or arg[0] not in self.prefix_chars or arg == '-':
+                return None if arg in names else i
+            if arg == '--':
+                return i
+            action = options.get(arg)
+            if action is None and '=' in arg:
+                action, arg = options.get(arg.split('=', 1)[0]), None
+            elif action is None and arg[:2] in options:
+                action, arg = options[arg[:2]], None
+            if action is None:
+                # not a global option, an option of the default subcommand
+                return i
+            if isinstance(action, argparse._HelpAction):
+                return None
+            i += 1
+            if arg is None:
+                # the value is attached to the option
+                continue
+            nargs = action.nargs
+            if nargs is None:
+                i += 1
+            elif isinstance(nargs, int):
+                i += nargs
+            elif nargs in ('*', '+', '?'):
+                while i < count and arg_strings[i][:1] not in \
+                        self.prefix_chars and arg_strings[i] not in names:
+                    i += 1
+                    if nargs == '?':
+                        break
+        return count
+
     def _parse_known_args(self, arg_strings, *args, **kwargs):
-        in_args = set(arg_strings)
         d_sp = self.__default_subparser
-        if d_sp is not None and not {'-h', '--help'}.intersection(in_args):
-            for x in self._subparsers._actions:
-                subparser_found = (
-                    isinstance(x, argparse._SubParsersAction) and
-                    in_args.intersection(x._name_parser_map.keys())
-                )
-                if subparser_found:
-                    break
-            else:
-                # insert default in first position, this implies no
-                # global options without a sub_parsers specified
-                arg_strings = [d_sp] + arg_strings
+        if d_sp is not None:
+            index = self._default_index(arg_strings)
+            if index is not None:
+                arg_strings = arg_strings[:index] + [d_sp] + \
+                    arg_strings[index:]
         return super(DefaultSubcommandArgParse, self)._parse_known_args(
             arg_strings, *args, **kwargs
         )
 
 
-class Mach(Cmd):
+class _LazyParsers(dict):
+    """A mapping of subcommand names to parsers built on first access"""
+
+    def __getitem__(self, name):
+        parser = super().__getitem__(name)
+        if not isinstance(parser, argparse.ArgumentParser):
+            parser = parser()
+            self[name] = parser
+        return parser
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+class LazySubParsersAction(argparse._SubParsersAction):
+    """
+    A subparsers action which registers only the names and the help of
+    the subcommands. The parser of a subcommand is created when the
+    subcommand is selected on the command line.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LazySubParsersAction, self).__init__(*args, **kwargs)
+        self._name_parser_map = self.choices = _LazyParsers()
+
+    def add_lazy_parser(self, name, build, **kwargs):
+        """
+        Register the subcommand ``name`` without creating its parser.
+
+        Args:
+            build (callable): called with the new parser to add the
+            arguments of the subcommand.
+        """
+        if kwargs.get('prog') is None:
+            kwargs['prog'] = '%s %s' % (self._prog_prefix, name)
+
+        if 'help' in kwargs:
+            self._choices_actions.append(
+                self._ChoicesPseudoAction(name, (), kwargs.pop('help')))
+
+        def create():
+            parser = self._parser_class(**kwargs)
+            build(parser)
+            return parser
+
+        self._name_parser_map[name] = create
+
+
+class _BlockBuffered:
+    """Block buffer the output of a shell and of ``print`` while in use"""
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.stdout = self.buffered = None
+
+    def __enter__(self):
+        stdout = self.stdout = self.shell.stdout
+        if stdout is sys.stdout and hasattr(stdout, 'buffer'):
+            stdout.flush()
+            self.buffered = io.TextIOWrapper(
+                stdout.buffer, encoding=stdout.encoding, errors=stdout.errors)
+            self.shell.stdout = sys.stdout = self.buffered
+
+    def __exit__(self, *exc_info):
+        if self.buffered is not None:
+            self.shell.stdout = sys.stdout = self.stdout
+            self.buffered.flush()
+            self.buffered.detach()
+
+
+class _RedirectOutput:
+    """
+    Write ``print`` and the output of a shell to ``stream`` while in use.
+
+    Args:
+        wrapped: replace the output of the shell only if it is this
+        stream, which ``stream`` wraps. By default it is always replaced.
+    """
+
+    def __init__(self, inst, stream, wrapped=None):
+        self.inst, self.stream, self.wrapped = inst, stream, wrapped
+        self.stdout = self.shell_stdout = None
+
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, self.stream
+        shell_stdout = getattr(self.inst, 'stdout', None)
+        if shell_stdout is not None and (
+                self.wrapped is None or shell_stdout is self.wrapped):
+            self.shell_stdout, self.inst.stdout = shell_stdout, self.stream
+        return self.stream
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+        if self.shell_stdout is not None:
+            self.inst.stdout = self.shell_stdout
+
+
+def _replace_file(path, write, binary=False):
+    """
+    Write ``path`` with ``write(file)`` through a temporary file which
+    then replaces it, so that readers never see a partial file. The
+    directory of ``path`` is created if needed.
+    """
+    import threading
+    os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+    tmp = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb' if binary else 'w') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def __getattr__(name):
+    # Mach derives from cmd.Cmd, the cmd module is imported only when a
+    # shell is needed. Python 3.7 and later, see the end of _Shell
+    if name == 'Mach':
+        return _shell_class()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _shell_class():
+    """create the base class of the classes decorated with ``mach2``"""
+    global Mach
+    try:
+        return Mach
+    except NameError:
+        from cmd import Cmd
+        Mach = type('Mach', (_Shell, Cmd), {'__module__': __name__})
+        return Mach
+
+
+class _Shell:
+    """The methods of ``Mach``, an interactive shell based on ``cmd.Cmd``"""
+
+    # Dispatch records of the commands, filled on first use of a command.
+    # Each class gets its own dict, from _mach or on first use
+    _commands = {}
+
+    # The sorted names of the commands, built with the class by _mach, and
+    # the sorted ``name=`` options of each command, filled on first Tab
+    _names = None
+    _options = {}
+
+    def completenames(self, text, *ignored):
+        if self._names is None:
+            return super(_Shell, self).completenames(text, *ignored)
+        return _prefixed(self._names, text)
+
+    def _complete_options(self, name, text, line):
+        """complete the ``name=`` options of a command not given in line"""
+        kls = type(self)
+        if '_options' not in kls.__dict__:
+            kls._options = {}
+        options = kls._options.get(name)
+        if options is None:
+            command = _command(self, name)
+            options = kls._options[name] = sorted(
+                keyword + "=" for keyword in command.keywords) \
+                if command else []
+        given = {item.partition("=")[0] + "="
+                 for item in line.split()[1:] if "=" in item}
+        return [option for option in _prefixed(options, text)
+                if option not in given]
+
+    # The reason why the last line could not be dispatched
+    lasterror = None
+
+    # Set by --timings and --profile, see onecmd and _call
+    _timings = False
+    _profile = None
+
+    # The Metrics of the commands, if enabled with ``metrics=True``
+    _metrics = None
+
+    # The number of background jobs, ``command &``, running at once
+    max_jobs = 4
+
+    def _error(self, message):
+        """report a line which could not be dispatched"""
+        self._set_error(message)
+        self.stdout.write(message + "\n")
+
+    def default(self, line):
+        self._set_error("Unknown syntax")
+        return super(_Shell, self).default(line)
+
+    def _set_error(self, message):
+        """
+        Keep why a line could not be dispatched in ``lasterror``, or in
+        the job running it, which does not touch the foreground line.
+        """
+        job = self._job()
+        if job is None:
+            self.lasterror = message
+        elif job.error is None:
+            job.error = message
+
+    def run_batch(self, script, stop_on_error=True):
+        """
+        Run the commands in ``script`` without prompting for input.
+
+        Empty lines and lines starting with ``#`` are skipped. The output
+        is block buffered, also when writing to a terminal.
+
+        Args:
+            script: an iterable of lines, e.g. an open file.
+            stop_on_error (bool): stop at the first line which fails.
+
+        Returns:
+            a list of ``(line number, line, error)`` for every line
+            which failed.
+        """
+        failures = []
+        with _BlockBuffered(self):
+            try:
+                for lineno, line in enumerate(script, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+
+                    self.lasterror = None
+                    line = self.precmd(line)
+                    try:
+                        stop = self.onecmd(line)
+                    except Exception as e:
+                        self.lasterror = "%s: %s" % (type(e).__name__, e)
+                        stop = False
+                    stop = self.postcmd(stop, line)
+
+                    if self.lasterror is not None:
+                        failures.append((lineno, line, self.lasterror))
+                        if stop_on_error:
+                            break
+                    if stop:
+                        break
+            finally:
+                # the jobs of the script write to the buffered output
+                self._close_jobs(cancel=False)
+
+        return failures
+
+    def cmdloop(self, intro=None):
+        try:
+            return super(_Shell, self).cmdloop(intro)
+        finally:
+            self._close_jobs()
+            self._close_loop()
+
+    def _job(self):
+        """the background job running in this thread, or None"""
+        jobs = self.__dict__.get('_jobs')
+        return getattr(getattr(jobs, 'local', None), 'job', None)
+
+    def _in_job(self):
+        """True in the thread of a background job"""
+        return self._job() is not None
+
+    def _submit_job(self, line):
+        jobs = self.__dict__.get('_jobs')
+        if jobs is None:
+            jobs = self._jobs = _Jobs(self)
+        job = jobs.submit(self, line)
+        self.stdout.write("[%d] %s\n" % (job.number, line))
+
+    def _close_jobs(self, cancel=True):
+        """
+        Wait for the running jobs, print their output and stop the pool.
+        Queued jobs are cancelled unless ``cancel`` is False.
+        """
+        jobs = self.__dict__.pop('_jobs', None)
+        if jobs is not None:
+            jobs.close(self, cancel)
+
+    def _select_jobs(self, ids):
+        """the jobs with the numbers ``ids``, all jobs if none are given"""
+        jobs = self.__dict__.get('_jobs')
+        if jobs is None:
+            return []
+        if not ids:
+            return list(jobs.jobs.values())
+        selected = []
+        for number in ids:
+            job = jobs.jobs.get(int(number)) if number.isdigit() else None
+            if job is None:
+                self._error("No job %s" % number)
+                return None
+            selected.append(job)
+        return selected
+
+    def do_jobs(self):
+        """list the background jobs, started with: command &"""
+        for job in self._select_jobs(()):
+            self.stdout.write("[%d] %-9s %s\n" % (
+                job.number, job.status, job.line))
+
+    def do_wait(self, *ids):
+        """wait for background jobs and print their output: wait [ID ...]"""
+        for job in self._select_jobs(ids) or ():
+            self.__dict__['_jobs'].wait(self, job)
+
+    def do_cancel(self, *ids):
+        """cancel background jobs which did not start: cancel [ID ...]"""
+        for job in self._select_jobs(ids) or ():
+            if job.future.cancel():
+                del self._jobs.jobs[job.number]
+                self.stdout.write("[%d] cancelled %s\n" % (
+                    job.number, job.line))
+            elif not ids:
+                continue
+            else:
+                self._error("Job %d is %s" % (job.number, job.status))
+
+    def postcmd(self, stop, line):
+        jobs = self.__dict__.get('_jobs')
+        if jobs is not None:
+            jobs.report(self)
+        return super(_Shell, self).postcmd(stop, line)
+
+    def _event_loop(self):
+        """the event loop of ``async def`` commands, kept for the session"""
+        loop = self.__dict__.get('_loop')
+        if loop is None or loop.is_closed():
+            import asyncio
+            loop = self._loop = asyncio.new_event_loop()
+        return loop
+
+    def _session_profiler(self):
+        """the profiler which collects the profiles of all the commands"""
+        if not self._profile:
+            return None
+        profiler = self.__dict__.get('_profiler')
+        if profiler is None:
+            import cProfile
+            profiler = self._profiler = cProfile.Profile()
+        return profiler
+
+    def _close_loop(self):
+        loop = self.__dict__.pop('_loop', None)
+        if loop is not None and not loop.is_closed():
+            _close_event_loop(loop)
 
     def onecmd(self, line):
+        started = time.perf_counter()
+        background = line.rstrip()
+        if background.endswith('&') and background[:-1].strip() and \
+                not self._in_job():
+            return self._submit_job(background[:-1].strip())
+
         cmd, arg, line = self.parseline(line)
         if not line:
             return self.emptyline()
         if cmd is None:
             return self.default(line)
-        self.lastcmd = line
-        if line == 'EOF':
-            self.lastcmd = ''
+        if not self._in_job():
+            self.lastcmd = line
+            if line == 'EOF':
+                self.lastcmd = ''
         if cmd == '':
             return self.default(line)
 
+        import shlex
         try:
             arg = shlex.split(arg)
         except ValueError as e:
-            self.stdout.write(line + ": %s\n" % e)
-            return
-
-        arg, args_with_val = partition(lambda x: "=" in x, arg)
-        di = {}
+            return self._error(line + ": %s" % e)
 
         try:
-            func = getattr(self, 'do_' + cmd)
-        except AttributeError:
-            # when a method is not found
-            return self.default(line)
+            command = self._commands[cmd]
+        except KeyError:
+            func = getattr(type(self), 'do_' + cmd, None)
+            if func is None:
+                # when a method is not found
+                return self.default(line)
+            command = command_spec(type(self), cmd, func)
 
-        sig = inspect.getfullargspec(func)
+        parsed = time.perf_counter()
+        arg, args_with_val = partition(lambda x: "=" in x, arg)
+        di = {}
         for item in args_with_val:
             name, val = item.split('=')
-            if name != sig.varkw and name not in sig.args[1:]:
-                self.stdout.write("Unknown option %s\n" % name)
-                return
+            if name not in command.keywords:
+                return self._error("Unknown option %s" % name)
             di[name] = val
 
-        if sig.varkw and sig.varkw in di:
+        varkw = command.varkw
+        if varkw and varkw in di:
+            import json
             try:
-                kwargs = json.loads(di.pop(sig.varkw))
+                kwargs = json.loads(di.pop(varkw))
                 di.update(kwargs)
             except json.decoder.JSONDecodeError:
-                self.stdout.write("Could not parse JSON in %s\n" % sig.varkw)
-                return
+                return self._error("Could not parse JSON in %s" % varkw)
+
+        if command.nargs is not None and len(arg) > command.nargs:
+            return self.default(line)
 
+        converters = command.converters
         try:
-            return func(*arg, **di)
+            if converters:
+                arg = [converters[name](val) if name in converters else val
+                       for name, val in zip(command.args, arg)] + \
+                    arg[len(command.args):]
+                for name in converters.keys() & di.keys():
+                    di[name] = converters[name](di[name])
+
+            if self._timings or self._profile or self._metrics:
+                converted = time.perf_counter()
+                return _call(self, command.func, [self] + arg, di,
+                             [('parse', parsed - started),
+                              ('convert', converted - parsed)],
+                             name=cmd, session=not self._in_job(),
+                             timings=self._timings, profile=self._profile,
+                             profiler=self._session_profiler())
+            if command.coroutine and self._in_job():
+                # the loop of the session belongs to the thread of the shell
+                return _complete(self, command.func(self, *arg, **di),
+                                 session=False)
+            if command.coroutine:
+                result = self._event_loop().run_until_complete(
+                    command.func(self, *arg, **di))
+                return _write_items(self, result)
+            return _write_items(self, command.func(self, *arg, **di))
         except ValueError:
             # when a method is wrongly used
             return self.default(line)
@@ -115,33 +622,375 @@ class Mach(Cmd):
         except TypeError as e:
             if e.args[0].endswith(
                     "missing 1 required positional argument: 'arg'"):
-                return func("")
+                return command.func(self, "")
             else:
                 return self.default(line)
 
 
+if sys.version_info < (3, 7):
+    # no module __getattr__ before Python 3.7 (PEP 562), cmd is imported
+    # with mach
+    _shell_class()
+
+
 _supported_types = {'str': str, 'float': float, 'int': int}
 
+# Arguments annotated with these types take the path of a file, and
+# receive its contents as a memoryview, see file_view
+_raw_types = {'bytes': bytes, 'memoryview': memoryview}
+
+# The annotation of an argument taking many values: the name of the
+# container, ``list`` or ``tuple``, the names of the types of the items
+# and whether it takes any number of them, e.g. ``List[int]``
+SequenceSpec = namedtuple('SequenceSpec', 'container types variadic')
+
+
+def sequence_type(annotation):
+    """
+    Return the :class:`SequenceSpec` of ``List[int]``, ``Tuple[int, float]``,
+    ``Tuple[float, ...]``, ``list`` and similar annotations, or None.
+    """
+    if isinstance(annotation, SequenceSpec):
+        return annotation
+    if annotation in (list, tuple):
+        return SequenceSpec(annotation.__name__, ('str',), True)
+    origin = _sequence_origin(annotation)
+    if origin is None:
+        return None
+    items = getattr(annotation, '__args__', None) or (str,)
+    variadic = origin is list or (len(items) == 2 and items[1] is Ellipsis)
+    if variadic:
+        items = items[:1]
+    names = tuple(getattr(item, '__name__', None) for item in items)
+    if not all(_supported_types.get(name) is item
+               for name, item in zip(names, items)):
+        return None
+    return SequenceSpec(origin.__name__, names, variadic)
+
+
+def _sequence_origin(annotation):
+    """list for ``List[...]``, tuple for ``Tuple[...]``, else None"""
+    origin = getattr(annotation, '__origin__', None)
+    if origin in (list, tuple):
+        return origin
+    # before Python 3.7 the origin is typing.List or typing.Tuple
+    if getattr(origin, '__module__', None) == 'typing':
+        return {'List': list, 'Tuple': tuple}.get(
+            getattr(origin, '__name__', None))
+    return None
+
+
+def sequence_name(sequence):
+    """the annotation of ``sequence`` as text, e.g. ``tuple[int, ...]``"""
+    items = sequence.types
+    if sequence.container == 'tuple' and sequence.variadic:
+        items += ('...',)
+    return "%s[%s]" % (sequence.container, ", ".join(items))
+
+
+def parse_sequence_name(name):
+    """the :class:`SequenceSpec` of a text written by :func:`sequence_name`"""
+    container, _, items = name.rstrip("]").partition("[")
+    items = tuple(item.strip() for item in items.split(","))
+    variadic = container == 'list' or items[-1] == '...'
+    return SequenceSpec(container, items[:1] if variadic else items, variadic)
+
+
+# numpy if it is installed, imported with the first array
+_numpy = None
+
+
+def _array(type_, values):
+    """
+    Convert ``values`` in one pass to a compact array of ``type_``: a
+    NumPy array if NumPy is installed, an ``array.array`` otherwise.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy = False
+    if _numpy:
+        return _numpy.fromiter(map(type_, values), count=len(values),
+                               dtype=_numpy.int64 if type_ is int
+                               else _numpy.float64)
+    from array import array
+    return array('q' if type_ is int else 'd', map(type_, values))
+
+
+def convert_sequence(sequence, values):
+    """
+    Convert the strings ``values`` to the items of ``sequence``. A single
+    string holds the values separated by commas or spaces.
+
+    Returns:
+        an array for any number of ints or floats, a list of strings, or
+        a tuple for a fixed number of items.
+    """
+    if isinstance(values, str):
+        values = values.replace(",", " ").split()
+    values = list(values)
+    if not sequence.variadic:
+        if len(values) != len(sequence.types):
+            raise ValueError("expected %d values, got %d" % (
+                len(sequence.types), len(values)))
+        return tuple(_supported_types[name](value)
+                     for name, value in zip(sequence.types, values))
+    type_ = _supported_types[sequence.types[0]]
+    if type_ is str:
+        return values if sequence.container == 'list' else tuple(values)
+    try:
+        return _array(type_, values)
+    except OverflowError as e:
+        raise ValueError(str(e))
+
+
+class _SequenceAction(argparse.Action):
+    """store the values of a ``List[int]`` or a ``Tuple`` argument"""
+
+    def __init__(self, *args, sequence=None, **kwargs):
+        super(_SequenceAction, self).__init__(*args, **kwargs)
+        self.sequence = sequence
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            values = convert_sequence(self.sequence, values)
+        except ValueError as e:
+            raise argparse.ArgumentError(
+                self, "invalid %s value: %s" % (
+                    sequence_name(self.sequence), e))
+        setattr(namespace, self.dest, values)
+
+
+class CommandSpec:
+    """
+    The signature of a command, inspected once and shared by the parser
+    of its subcommand, the command line and the shell.
+
+    Attributes:
+        func: the function implementing the command.
+        args: the names of the positional arguments, without ``self``.
+        defaults: the default values of the last ``args``, or None.
+        annotations: the annotations of the arguments.
+        keywords: the names which can be given as ``name=value``.
+        varkw: the name of the ``**kwargs`` argument, given as JSON.
+        nargs: the maximal number of positional arguments, ``None`` if
+        the function takes ``*args``.
+        converters: the type conversion of annotated arguments.
+        coroutine: True for an ``async def`` command.
+    """
+
+    __slots__ = ('func', 'args', 'defaults', 'annotations', 'keywords',
+                 'varkw', 'nargs', 'converters', 'coroutine')
+
+    def __init__(self, func, sig=None):
+        """
+        Args:
+            sig: the ``inspect.FullArgSpec`` of ``func`` or an
+            :class:`ArgSpec` loaded from the cache, inspected if None.
+        """
+        if sig is None:
+            import inspect
+            sig = inspect.getfullargspec(func)
+        args = tuple(sig.args[1:])
+        keywords = set(args)
+        if sig.varkw:
+            keywords.add(sig.varkw)
+        converters = {}
+        for name, type_ in sig.annotations.items():
+            sequence = sequence_type(type_)
+            type_name = getattr(type_, '__name__', None)
+            type_ = _supported_types.get(type_name)
+            if name not in keywords:
+                continue
+            if sequence:
+                converters[name] = _sequence_converter(sequence)
+            elif _raw_types.get(type_name) is sig.annotations[name]:
+                converters[name] = file_view
+            elif type_ not in (None, str):
+                converters[name] = type_
+
+        set_ = super(CommandSpec, self).__setattr__
+        set_('func', func)
+        set_('args', args)
+        set_('defaults', tuple(sig.defaults) if sig.defaults else None)
+        set_('annotations', sig.annotations)
+        set_('keywords', frozenset(keywords))
+        set_('varkw', sig.varkw)
+        set_('nargs', None if sig.varargs else len(args))
+        set_('converters', converters)
+        # CO_COROUTINE, as inspect.iscoroutinefunction without the import
+        code = getattr(func, '__code__', None)
+        set_('coroutine', bool(code and code.co_flags & 0x80))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CommandSpec is read only")
+
+    def __repr__(self):
+        return "CommandSpec(%s%r)" % (self.func.__name__, self.args)
+
+
+def _sequence_converter(sequence):
+    return lambda values: convert_sequence(sequence, values)
+
+
+def command_spec(kls, name, func=None, sig=None):
+    """
+    Return the :class:`CommandSpec` of the command ``name`` of ``kls``.
+
+    The spec is created on first use and kept in ``kls._commands``.
+    ``func`` is the function of the command, by default the method
+    ``name`` of ``kls``, or ``do_<name>`` for shells.
+    """
+    commands = kls.__dict__.get('_commands')
+    if commands is None:
+        commands = {}
+        setattr(kls, '_commands', commands)
+    try:
+        return commands[name]
+    except KeyError:
+        if func is None:
+            # the methods of a shell may shadow a command, but not do_<name>
+            prefix = 'do_' if issubclass(kls, _Shell) else ''
+            func = getattr(kls, prefix + name)
+        spec = commands[name] = CommandSpec(func, sig)
+        return spec
+
+
+# Section headers of Google and NumPy style docstrings, the arguments
+# are described in the sections in _ARGUMENT_SECTIONS
+_ARGUMENT_SECTIONS = frozenset([
+    'args', 'arguments', 'parameters', 'params', 'keyword args',
+    'keyword arguments', 'other parameters'])
+_SECTIONS = _ARGUMENT_SECTIONS | frozenset([
+    'returns', 'return', 'yields', 'yield', 'raises', 'warns', 'receives',
+    'attributes', 'methods', 'note', 'notes', 'example', 'examples',
+    'warning', 'warnings', 'see also', 'references', 'todo'])
+
+
+def _argument_name(text):
+    """the name of the argument described in ``text`` or None"""
+    name = text.strip()
+    if name.endswith(')') and '(' in name:
+        name = name[:name.index('(')].rstrip()
+    name = name.lstrip('*')
+    return name if name.isidentifier() else None
+
 
 def parse_docs(docstring):
     """
     Parse documentation string and create a help string
+
+    The first paragraph is the help of the command. The arguments are
+    described as ``name - description``, in an ``Args:`` section or in a
+    NumPy ``Parameters`` section, descriptions may span several lines.
+    The text below a ``---`` line is added to the help of the command.
+    Other sections are skipped.
     """
-    extra = re.search("---", docstring)
-    if extra: docstring = docstring[:extra.start()]
-    else: extra = ""
-    doc = docstring.lstrip("\n").split("\n")
-    try:
-        doc_dict = {'cmd': doc[0] + extra.string[extra.start() + 3:]}
-    except AttributeError:
-        doc_dict = {'cmd': doc[0]}
+    lines = (docstring or "").strip().split("\n")
+    summary, extra, doc = [], None, {}
+    in_summary = True
+    # the current section: None for the body, True for arguments and
+    # False for other sections, and the indentation of its header
+    section, indent, numpy = None, 0, False
+    name, name_indent = None, 0
+
+    count, i = len(lines), 0
+    while i < count:
+        line = lines[i]
+        text = line.strip()
+        i += 1
+        if not text:
+            in_summary = in_summary and not summary
+            if section is None:
+                name = None
+            continue
+
+        level = len(line) - len(line.lstrip())
+        if text.startswith('---'):
+            extra = "\n".join([text.lstrip('-').strip()] + lines[i:])
+            break
+
+        header = text.lower()
+        if i < count and header in _SECTIONS and \
+                lines[i].strip().startswith('---'):
+            # a NumPy section, the header is underlined with dashes
+            section, indent, numpy, name = header in _ARGUMENT_SECTIONS, \
+                level, True, None
+            i += 1
+            continue
+        if header.endswith(':') and header[:-1] in _SECTIONS:
+            section, indent, numpy, name = header[:-1] in _ARGUMENT_SECTIONS, \
+                level, False, None
+            continue
+        if section is not None and not numpy and level <= indent:
+            section, name = None, None
+
+        if section is False:
+            continue
+        if section:
+            if numpy and level <= indent:
+                name, _, _ = text.partition(':')
+                name, desc = _argument_name(name), ""
+            elif not numpy and (name is None or level <= name_indent):
+                name, sep, desc = text.partition(':')
+                if not sep:
+                    name, sep, desc = text.partition(' - ')
+                name = _argument_name(name) if sep else None
+            else:
+                if name:
+                    doc[name] = (doc[name] + " " + text).lstrip()
+                continue
+            if name:
+                doc[name], name_indent = desc.strip(), level
+            continue
+
+        key, sep, desc = text.partition(' - ')
+        key = _argument_name(key) if sep and summary else None
+        if key:
+            doc[key], name, in_summary = desc.strip(), key, False
+        elif in_summary:
+            summary.append(text)
+        elif name:
+            doc[name] += " " + text
 
-    if len(doc) > 1:
-        doc = {k: v for k, v in
-               (item.split(' - ') for item in
-                list(filter(lambda x: x, doc))[1:])}
-        doc_dict.update(doc)
-    return doc_dict
+    doc['cmd'] = " ".join(summary) + (extra if extra is not None else "")
+    return doc
+
+
+# parse_docs of each function, with the docstring which was parsed. A
+# WeakKeyDictionary, created when it is first needed, so that functions
+# and classes created at run time can be collected
+_parsed_docs = None
+
+
+def function_docs(function):
+    """
+    Return the cleaned docstring of ``function`` and its
+    :func:`parse_docs`. Both are kept until the docstring changes,
+    so a function is parsed once, however often its class is decorated.
+    """
+    global _parsed_docs
+    if _parsed_docs is None:
+        import weakref
+        _parsed_docs = weakref.WeakKeyDictionary()
+    raw = function.__doc__
+    try:
+        cached = _parsed_docs.get(function)
+    except TypeError:
+        # e.g. a builtin, which can not be weakly referenced
+        cached = None
+    if cached is not None and cached[0] is raw:
+        return cached[1], cached[2]
+    import inspect
+    docstring = inspect.getdoc(function)
+    doc = parse_docs(docstring)
+    try:
+        _parsed_docs[function] = raw, docstring, doc
+    except TypeError:
+        pass
+    return docstring, doc
 
 
 def add_parsers(name, function, doc, sig, subparsers):
@@ -149,21 +998,37 @@ def add_parsers(name, function, doc, sig, subparsers):
     subp = subparsers.add_parser(
         name, formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         help=doc['cmd'])
+    add_arguments(subp, doc, CommandSpec(function, sig))
+
+    return name, function, doc
 
-    idx_args_with_defaults = len(sig.defaults) if sig.defaults else 0
 
-    if sig.defaults:
-        _defaults = list(reversed(sig.defaults))
+def add_arguments(subp, doc, spec):
+    """add the arguments of a command to the parser of its subcommand"""
+    idx_args_with_defaults = len(spec.defaults) if spec.defaults else 0
 
-    for idx, val in enumerate(reversed(sig.args[1:])):
+    if spec.defaults:
+        _defaults = list(reversed(spec.defaults))
+
+    for idx, val in enumerate(reversed(spec.args)):
         subpargs, opts = [], {}
         opts['help'] = doc.get(val, '')
-        type_ = sig.annotations.get(val)
-        if type_ and type_.__name__ == 'bool':
+        type_ = spec.annotations.get(val)
+        sequence = sequence_type(type_)
+        type_name = getattr(type_, '__name__', None)
+        if sequence:
+            opts['action'] = _SequenceAction
+            opts['sequence'] = sequence
+            opts['nargs'] = '+' if sequence.variadic else len(sequence.types)
+        elif type_name == 'bool':
             opts['action'] = "store_true"
-        elif type_ and type_.__name__ in _supported_types:
-                opts['type'] = _supported_types[type_.__name__]
+        elif type_name in _raw_types and _raw_types[type_name] is type_:
+            opts['type'], opts['metavar'] = file_view, 'FILE'
+        elif type_name in _supported_types:
+                opts['type'] = _supported_types[type_name]
         if idx_args_with_defaults and idx < idx_args_with_defaults:
+            if sequence and sequence.variadic:
+                opts['nargs'] = '*'
             opts['default'] = _defaults[idx]
             if len(val) == 1:
                 subpargs.append("-" + val)
@@ -174,11 +1039,198 @@ def add_parsers(name, function, doc, sig, subparsers):
             subpargs.append(val)
 
         subp.add_argument(*subpargs, **opts)
-    if sig.varkw:
-        subp.add_argument("--" + sig.varkw,
+    if spec.varkw:
+        subp.add_argument("--" + spec.varkw,
                           help="Additional options loaded from JSON")
 
-    return name, function, doc
+
+def lazy_arguments(kls, name, function, doc, sig=None):
+    """defer the introspection of ``function`` until its parser is built"""
+    return lambda subp: add_arguments(
+        subp, doc, command_spec(kls, name, function, sig))
+
+
+# The namespace attribute holding the names of the selected command group
+_GROUP = 'mach group'
+
+
+def import_group(path):
+    """import the class of a command group given as ``module.Class``"""
+    import importlib
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def add_groups(subparsers, groups, names=()):
+    """
+    Register the command groups of a class as lazy subcommands.
+
+    Args:
+        groups (dict): maps the name of each group to the import path
+        of its class, ``module.Class``, or to a tuple of the path and the
+        help of the group.
+        names (tuple): the names of the enclosing groups.
+    """
+    for name, path in sorted(groups.items()):
+        path, help_ = (path, None) if isinstance(path, str) else path
+        subparsers.add_lazy_parser(
+            name, lazy_group(path, names + (name,)),
+            help=help_ or "the commands of %s" % name)
+
+
+def lazy_group(path, names):
+    """defer the import of a command group until its parser is built"""
+    def add(subp):
+        kls = import_group(path)
+        subp.set_defaults(**{_GROUP: names})
+        if hasattr(kls, 'default'):
+            subp.set_default_subparser(kls.default)
+        subparsers = subp.add_subparsers(help='commands', dest="cmd",
+                                         action=LazySubParsersAction)
+        for name, function, _d, doc, sig in inspect_commands(kls):
+            subparsers.add_lazy_parser(
+                name, lazy_arguments(kls, name, function, doc, sig),
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                help=doc['cmd'])
+        add_groups(subparsers, getattr(kls, 'groups', {}), names)
+        subp.subcommands = subparsers
+    return add
+
+
+def _resolve_group(inst, names):
+    """the instance and the parser of the command group ``names``"""
+    parser = inst.parser
+    for name in names:
+        path = type(inst).groups[name]
+        path = path if isinstance(path, str) else path[0]
+        inst, parser = import_group(path)(), parser.subcommands.choices[name]
+    return inst, parser
+
+
+def inspect_commands(kls):
+    """
+    Find the commands of ``kls``.
+
+    Returns:
+        a list of ``(name, function, docstring, doc, sig)``. ``sig``
+        is None, the signature is inspected when it is needed.
+    """
+    import inspect
+    commands = []
+    for (name, function) in inspect.getmembers(kls, predicate=not_private):
+        _d, doc = function_docs(function)
+        commands.append((name, function, _d, doc, None))
+    return commands
+
+
+_annotation_types = dict(_supported_types, bool=bool, bytes=bytes,
+                         memoryview=memoryview)
+
+# The fields of inspect.FullArgSpec, for signatures loaded from a cache
+ArgSpec = namedtuple('ArgSpec', 'args varargs varkw defaults kwonlyargs '
+                                'kwonlydefaults annotations')
+
+
+def _spec_path(kls, spec_cache):
+    path = getattr(sys.modules.get(kls.__module__), '__file__', None)
+    if path is None:
+        # classes defined in an interactive session are not cached
+        return None
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(spec_cache, "%s.%s.json" % (name, kls.__qualname__))
+
+
+def _spec_key(kls):
+    """the version of mach and the state of the sources defining ``kls``"""
+    sources = {}
+    for base in kls.__mro__:
+        path = getattr(sys.modules.get(base.__module__), '__file__', None)
+        if path and path not in sources:
+            st = os.stat(path)
+            sources[path] = [st.st_mtime_ns, st.st_size]
+    return {'version': __version__, 'sources': sources}
+
+
+def load_spec(kls, spec_cache):
+    """
+    Load the commands of ``kls`` from the cache directory ``spec_cache``.
+
+    Returns:
+        the commands like :func:`inspect_commands`, or None if the cache
+        is missing or the sources of ``kls`` changed since it was written.
+    """
+    import json
+    path = _spec_path(kls, spec_cache)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            spec = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if spec.get('key') != _spec_key(kls):
+        return None
+
+    commands = []
+    for item in spec['commands']:
+        sig = ArgSpec(
+            item['args'], item['varargs'], item['varkw'],
+            tuple(item['defaults']) if item['defaults'] else None, [], None,
+            {name: _annotation_types.get(type_) or parse_sequence_name(type_)
+             for name, type_ in item['annotations'].items()})
+        commands.append((item['name'], getattr(kls, item['name']),
+                         item['docstring'], item['doc'], sig))
+    return commands
+
+
+def _dump_annotations(annotations):
+    """the annotations mach converts, as names which can be loaded"""
+    names = {}
+    for arg, type_ in annotations.items():
+        sequence = sequence_type(type_)
+        if sequence:
+            names[arg] = sequence_name(sequence)
+        elif _annotation_types.get(getattr(type_, '__name__', None)) \
+                is type_:
+            names[arg] = type_.__name__
+    return names
+
+
+def dump_spec(kls, spec_cache, commands):
+    """
+    Write the commands of ``kls`` to the cache directory ``spec_cache``.
+
+    Nothing is written if the default values of a command can not be
+    stored as JSON without changing their type.
+    """
+    import inspect
+    import json
+    items = []
+    for name, function, docstring, doc, sig in commands:
+        sig = sig or inspect.getfullargspec(function)
+        defaults = list(sig.defaults) if sig.defaults else None
+        try:
+            if defaults and json.loads(json.dumps(defaults)) != defaults:
+                return
+        except (TypeError, ValueError):
+            # e.g. a datetime.date
+            return
+        items.append({
+            'name': name, 'docstring': docstring, 'doc': doc,
+            'args': sig.args, 'varargs': sig.varargs, 'varkw': sig.varkw,
+            'defaults': defaults,
+            'annotations': _dump_annotations(sig.annotations)})
+
+    path = _spec_path(kls, spec_cache)
+    if path is None:
+        return
+    spec = {'key': _spec_key(kls), 'commands': items}
+    try:
+        _replace_file(path, lambda f: json.dump(spec, f))
+    except OSError:
+        # a cache which can not be written only costs startup time
+        pass
 
 
 def create_helper(doc, name):
@@ -188,12 +1240,15 @@ def create_helper(doc, name):
 def not_private(x):
     """find all methods which do not have a name which starts with _"""
     try:
-        return not x.__name__.startswith("_") and inspect.isfunction(x)
+        return not x.__name__.startswith("_") and \
+            isinstance(x, types.FunctionType)
     except AttributeError:
         return False
 
 
-def _mach(kls, add_do=False, explicit=True, auto_help=True):
+def _mach(kls, add_do=False, explicit=True, auto_help=True,
+          spec_cache=None, timings=False, fan_out=False, daemon=False,
+          jsonl=False, completion=False, args_file=False, metrics=False):
     """
     Args:
         add_do (bool): for each method add a method prefixed with do_`name`.
@@ -201,49 +1256,1523 @@ def _mach(kls, add_do=False, explicit=True, auto_help=True):
         explicit (bool): add argument `--shell` to start a program shell.
         If set to false calling ``prog.py`` will start a shell.
         auto_help (bool): Automatically add a help for the program.
+        spec_cache (str): a directory for caching the commands of the
+        class between runs of the program.
+        timings (bool): add the arguments `--timings` to report the time
+        spent in each phase of running a command and `--profile` to
+        profile the commands.
+        fan_out (bool): add the arguments `--map`, `--jobs` and
+        `--unordered` to run a command for every line of a file in a
+        pool of threads.
+        daemon (bool): add the arguments `--serve` and `--idle-timeout` to
+        serve the commands on a Unix socket, see :func:`serve`.
+        jsonl (bool): add the argument `--jsonl` to run the commands
+        requested as JSON lines on stdin, see :func:`run_jsonl`.
+        completion (bool): add the argument `--completion` to print a
+        completion script for bash, zsh or fish. With `spec_cache`, the
+        script is also saved there and refreshed when the class changes.
+        args_file (bool): read the arguments from the file `FILE` given as
+        `@FILE`, one per line, see :class:`ArgsFileArgParse`.
+        metrics (bool): count the calls and errors and measure the latency
+        of each command, see :class:`Metrics`. Adds the argument
+        `--metrics FILE` to write them on exit, and the command `stats`
+        to the shell.
     """
-    if hasattr(kls, 'default'):
-        parser = DefaultSubcommandArgParse(
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    else:
-        parser = argparse.ArgumentParser(
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    build_started = time.perf_counter()
+    # The parser is shared by all instances of the class, options which
+    # are added in ``__init__`` replace the ones added by an earlier instance
+    parser = DefaultSubcommandArgParse(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        conflict_handler='resolve',
+        fromfile_prefix_chars='@' if args_file else None)
 
     if explicit:
         parser.add_argument("--shell",
                             action='store_true',
                             help="run an interactive shell")
 
-    subparsers = parser.add_subparsers(help='commands', dest="cmd")
+    if timings:
+        parser.add_argument("--timings", action='store_true',
+                            help="report the time spent in each phase of "
+                                 "running a command on stderr")
+        parser.add_argument("--profile", metavar="FILE",
+                            help="write a cProfile of the command to FILE")
+
+    if metrics:
+        parser.add_argument("--metrics", metavar="FILE",
+                            help="write the calls, errors and latency of "
+                                 "the commands to FILE on exit, as JSON if "
+                                 "FILE ends with .json, else in the "
+                                 "Prometheus text format")
+
+    if fan_out:
+        _add_fan_out_arguments(parser)
+
+    if daemon:
+        parser.add_argument("--serve", metavar="SOCKET",
+                            help="serve the commands on the Unix socket "
+                                 "SOCKET, run them with python -m mach "
+                                 "SOCKET ARGS")
+        parser.add_argument("--idle-timeout", metavar="SECONDS", type=float,
+                            help="stop serving after SECONDS without a "
+                                 "client")
+
+    if completion:
+        parser.add_argument("--completion", choices=COMPLETION_SHELLS,
+                            help="print a completion script for the shell")
+
+    if jsonl:
+        parser.add_argument("--jsonl", action='store_true',
+                            help="run the commands requested as JSON lines "
+                                 "on stdin and write JSON results")
 
     if add_do:
-        do_kls = type(kls.__name__, (Mach, kls), {})
+        parser.add_argument("--batch", metavar="FILE",
+                            type=argparse.FileType('r'),
+                            help="run the commands in FILE, - for stdin")
+        parser.add_argument("--keep-going", action='store_true',
+                            help="continue a batch after a failing command")
 
-    for (name, function) in inspect.getmembers(kls,
-                                               predicate=not_private):
-        _d = inspect.getdoc(function)
-        doc = parse_docs(_d)
-        sig = inspect.getfullargspec(function)
-        add_parsers(name, function, doc, sig, subparsers)
+    subparsers = parser.add_subparsers(help='commands', dest="cmd",
+                                       action=LazySubParsersAction)
+
+    if add_do:
+        # dicts of its own, no __init_subclass__ before Python 3.6
+        do_kls = type(kls.__name__, (_shell_class(), kls),
+                      {'_commands': {}, '_options': {}})
+
+    commands = load_spec(kls, spec_cache) if spec_cache else None
+    changed = commands is None
+    if changed:
+        commands = inspect_commands(kls)
+        if spec_cache:
+            dump_spec(kls, spec_cache, commands)
+
+    # completion scripts saved by --completion are refreshed with the spec
+    path = _spec_path(kls, spec_cache) if spec_cache else None
+    parser.completion_files = os.path.splitext(path)[0] if path else None
+
+    # what _fast_parse needs to parse a command without its subparser
+    parser.signatures, parser.fast_paths = {}, {}
+    for name, function, _d, doc, sig in commands:
+        subparsers.add_lazy_parser(
+            name, lazy_arguments(do_kls if add_do else kls, name, function,
+                                 doc, sig),
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help=doc['cmd'])
+        parser.signatures[name] = do_kls if add_do else kls, function, sig
 
         if add_do:
             setattr(do_kls, "do_%s" % name, function)
             setattr(do_kls, "help_%s" % name, create_helper(_d, name))
+            if not hasattr(kls, "complete_%s" % name):
+                setattr(do_kls, "complete_%s" % name,
+                        _option_completer(name))
+
+    if add_do and metrics and not hasattr(kls, 'stats'):
+        do_kls.do_stats = _show_stats
+
+    add_groups(subparsers, getattr(kls, 'groups', {}))
 
     if hasattr(kls, 'default'):
         parser.set_default_subparser(kls.default)
 
     if add_do:
         kls = do_kls
+        kls._names = sorted(
+            name[3:] for name in dir(kls) if name.startswith("do_"))
+    else:
+        kls._commands = {}
+    kls._metrics = Metrics() if metrics else None
 
     parser.auto_help = auto_help
+    parser.subcommands = subparsers
+    parser.fan_out = fan_out
+    global _startup_seconds
+    parser.startup_seconds = None
+    if _startup_seconds is None:
+        parser.startup_seconds = _startup_seconds = \
+            build_started - _imported
+    parser.build_seconds = time.perf_counter() - build_started
+    # --timings reports the build with the first command which follows it
+    parser.build_reported = False
     kls.parser = parser
+
+    if changed and parser.completion_files:
+        _write_completions(parser, [
+            shell for shell in COMPLETION_SHELLS if os.path.exists(
+                "%s.%s" % (parser.completion_files, shell))])
     return kls
 
 
-def _run1(inst, args=None):
+def _prefixed(names, prefix):
+    """the items of the sorted list ``names`` starting with ``prefix``"""
+    from bisect import bisect_left
+    start = bisect_left(names, prefix)
+    end = start
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+
+def _option_completer(name):
+    """create the ``complete_<name>`` method of a shell command"""
+    def complete(self, text, line, begidx, endidx):
+        return self._complete_options(name, text, line[:begidx])
+    complete.__name__ = "complete_%s" % name
+    return complete
+
+
+def _completion_spec(parser):
+    """
+    Collect the options and the subcommands of ``parser``.
+
+    Returns:
+        a tuple of the flags, the options taking a value, a dict of the
+        choices of options and a dict of the subcommands, with the spec
+        of each subcommand.
+    """
+    flags, options, choices, subcommands = [], [], {}, {}
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            for name, subparser in action.choices.items():
+                subcommands[name] = _completion_spec(subparser)
+        elif action.option_strings:
+            (flags if action.nargs == 0 else options).extend(
+                action.option_strings)
+            if action.choices:
+                for option in action.option_strings:
+                    choices[option] = [str(c) for c in action.choices]
+    return flags, options, choices, subcommands
+
+
+def _value_options(spec):
+    """the options taking a file name and the options with choices"""
+    _, options, choices, subcommands = spec
+    files, choices = set(options), dict(choices)
+    for _, sub_options, sub_choices, _ in subcommands.values():
+        files.update(sub_options)
+        choices.update(sub_choices)
+    return sorted(files.difference(choices)), sorted(choices.items())
+
+
+def _shell_name(prog):
+    return "".join(c if c.isalnum() else "_" for c in prog)
+
+
+def _bash_completion(prog, spec):
+    flags, options, _, subcommands = spec
+    cases = ['        "") words="%s";;' % " ".join(
+        flags + options + sorted(subcommands))]
+    for name, (sub_flags, sub_options, _, _) in sorted(subcommands.items()):
+        cases.append('        %s) words="%s";;' % (
+            name, " ".join(sub_flags + sub_options)))
+    files, choices = _value_options(spec)
+
+    lines = [
+        "# bash completion for %s, generated by mach %s" % (
+            prog, __version__),
+        "_mach_%s() {" % _shell_name(prog),
+        '    local cur prev cmd words i',
+        '    cur="${COMP_WORDS[COMP_CWORD]}"',
+        '    prev="${COMP_WORDS[COMP_CWORD-1]}"',
+    ]
+    if files or choices:
+        lines.append('    case "$prev" in')
+        for option, values in choices:
+            lines.append('        %s) COMPREPLY=($(compgen -W "%s" -- '
+                         '"$cur")); return;;' % (option, " ".join(values)))
+        if files:
+            lines.append('        %s) COMPREPLY=($(compgen -f -- "$cur")); '
+                         'return;;' % "|".join(files))
+        lines.append('    esac')
+    if subcommands:
+        lines += [
+            '    for ((i = 1; i < COMP_CWORD; i++)); do',
+            '        case "${COMP_WORDS[i]}" in',
+            '            %s) cmd="${COMP_WORDS[i]}"; break;;' % (
+                "|".join(sorted(subcommands))),
+            '        esac',
+            '    done']
+    lines += ['    case "$cmd" in'] + cases + [
+        '    esac',
+        '    COMPREPLY=($(compgen -W "$words" -- "$cur"))',
+        '}',
+        'complete -o default -F _mach_%s %s' % (_shell_name(prog), prog),
+        '']
+    return "\n".join(lines)
+
+
+def _zsh_completion(prog, spec):
+    flags, options, _, subcommands = spec
+    cases = ["        ('') compadd -- %s;;" % " ".join(
+        flags + options + sorted(subcommands))]
+    for name, (sub_flags, sub_options, _, _) in sorted(subcommands.items()):
+        cases.append("        (%s) compadd -- %s;;" % (
+            name, " ".join(sub_flags + sub_options)))
+    files, choices = _value_options(spec)
+
+    lines = [
+        "#compdef %s" % prog,
+        "# zsh completion for %s, generated by mach %s" % (
+            prog, __version__),
+        "_mach_%s() {" % _shell_name(prog),
+        "    local cmd i",
+    ]
+    if files or choices:
+        lines.append("    case ${words[CURRENT-1]} in")
+        for option, values in choices:
+            lines.append("        (%s) compadd -- %s; return;;" % (
+                option, " ".join(values)))
+        if files:
+            lines.append("        (%s) _files; return;;" % "|".join(files))
+        lines.append("    esac")
+    if subcommands:
+        lines += [
+            "    for ((i = 2; i < CURRENT; i++)); do",
+            "        case ${words[i]} in",
+            "            (%s) cmd=${words[i]}; break;;" % (
+                "|".join(sorted(subcommands))),
+            "        esac",
+            "    done"]
+    lines += ["    case $cmd in"] + cases + [
+        "    esac",
+        "}",
+        "compdef _mach_%s %s" % (_shell_name(prog), prog),
+        ""]
+    return "\n".join(lines)
+
+
+def _fish_quote(text):
+    return "'%s'" % (text or "").replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _fish_option(option_string):
+    if option_string.startswith("--"):
+        return "-l %s" % option_string[2:]
+    if len(option_string) == 2:
+        return "-s %s" % option_string[1:]
+    return "-o %s" % option_string[1:]
+
+
+def _fish_completion(prog, parser):
+    lines = ["# fish completion for %s, generated by mach %s" % (
+        prog, __version__),
+        "complete -c %s -f" % prog]
+
+    def options(parser, condition):
+        for action in parser._actions:
+            if not action.option_strings or action.help == argparse.SUPPRESS:
+                continue
+            if action.nargs == 0:
+                values = ""
+            elif action.choices:
+                values = " -r -f -a %s" % _fish_quote(
+                    " ".join(str(c) for c in action.choices))
+            else:
+                values = " -r -F"
+            lines.append("complete -c %s -n %s %s%s -d %s" % (
+                prog, _fish_quote(condition),
+                " ".join(_fish_option(o) for o in action.option_strings),
+                values, _fish_quote(action.help)))
+
+    subparsers = getattr(parser, 'subcommands', None)
+    names = sorted(subparsers.choices) if subparsers else []
+    options(parser, "__fish_use_subcommand")
+    if subparsers:
+        helps = {a.dest: a.help for a in subparsers._choices_actions}
+        for name in names:
+            lines.append("complete -c %s -n __fish_use_subcommand -a %s "
+                         "-d %s" % (prog, name, _fish_quote(helps.get(name))))
+            options(subparsers.choices[name],
+                    "__fish_seen_subcommand_from %s" % name)
+    lines.append("")
+    return "\n".join(lines)
+
+
+COMPLETION_SHELLS = ('bash', 'zsh', 'fish')
+
+
+def completion_script(parser, shell, prog=None):
+    """
+    Create a completion script for the program of ``parser``.
+
+    The script holds the names of the subcommands and their options, so
+    completing does not start Python. All subcommand parsers are built.
+
+    Args:
+        shell (str): one of ``bash``, ``zsh`` or ``fish``.
+        prog (str): the name of the program, ``parser.prog`` by default.
+    """
+    prog = prog or parser.prog
+    if shell == 'fish':
+        return _fish_completion(prog, parser)
+    spec = _completion_spec(parser)
+    if shell == 'zsh':
+        return _zsh_completion(prog, spec)
+    return _bash_completion(prog, spec)
+
+
+def _write_completions(parser, shells):
+    """write the completion scripts next to the spec cache of the class"""
+    for shell in shells:
+        path = "%s.%s" % (parser.completion_files, shell)
+        try:
+            with open(path, 'w') as f:
+                f.write(completion_script(parser, shell))
+        except OSError:
+            pass
+
+
+_build_cache = {}
+
+
+def _mach_cached(kls, **options):
+    """
+    Build the interface of ``kls`` once for every combination of options.
+
+    The decorated class, its parser and the command metadata are shared by
+    all instances, use :func:`clear_cache` to force a rebuild.
+    """
+    key = (kls, tuple(sorted(options.items())))
+    try:
+        return _build_cache[key]
+    except KeyError:
+        built = _build_cache[key] = _mach(kls, **options)
+        return built
+
+
+def clear_cache(kls=None):
+    """
+    Drop the interfaces built by :func:`mach1` and :func:`mach2`.
+
+    Args:
+        kls: a decorated class. If given, only the interfaces of this
+        class are dropped, otherwise the whole cache is emptied.
+    """
+    if kls is None:
+        _build_cache.clear()
+        if _parsed_docs is not None:
+            _parsed_docs.clear()
+        return
+    kls = getattr(kls, '__wrapped__', kls)
+    for key in [key for key in _build_cache if key[0] is kls]:
+        del _build_cache[key]
+
+
+# returned by _Memo.get for results which are not cached
+_missing = object()
+
+
+class _Memo:
+    """
+    The results of a command decorated with :func:`memoize`: a LRU in
+    memory for shells and an optional directory for one-shot runs.
+    """
+
+    def __init__(self, function, ttl, maxsize, store, max_bytes):
+        import inspect
+        import threading
+        from collections import OrderedDict
+        self.function = function
+        self.signature = inspect.signature(function)
+        self.ttl, self.maxsize = ttl, maxsize
+        self.store = os.path.expanduser(store) if store else None
+        self.max_bytes = max_bytes
+        self.lru = OrderedDict()
+        # background jobs and the clients of a daemon share the LRU
+        self.lock = threading.Lock()
+
+    def key(self, args, kwargs):
+        """the arguments of a call, without ``self``, as a string"""
+        import json
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return json.dumps(list(bound.arguments.items())[1:], default=repr,
+                          sort_keys=True)
+
+    def expired(self, stamp):
+        return self.ttl is not None and time.time() - stamp > self.ttl
+
+    def get(self, inst, key):
+        """return the cached result of ``key`` or ``_missing``"""
+        if isinstance(inst, _Shell) or not self.store:
+            with self.lock:
+                try:
+                    stamp, value = self.lru[key]
+                except KeyError:
+                    return _missing
+                if self.expired(stamp):
+                    del self.lru[key]
+                    return _missing
+                self.lru.move_to_end(key)
+                return value
+
+        import pickle
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                stamp, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _missing
+        if self.expired(stamp):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return _missing
+        return value
+
+    def put(self, inst, key, value):
+        if isinstance(inst, _Shell) or not self.store:
+            with self.lock:
+                self.lru[key] = time.time(), value
+                self.lru.move_to_end(key)
+                while len(self.lru) > self.maxsize:
+                    self.lru.popitem(last=False)
+            return
+
+        import pickle
+        path = self.path(key)
+        try:
+            _replace_file(
+                path, lambda f: pickle.dump((time.time(), value), f),
+                binary=True)
+        except (OSError, pickle.PicklingError, AttributeError, TypeError):
+            # a result which can not be stored is computed again next time
+            return
+        if self.max_bytes is not None:
+            self.evict()
+
+    def path(self, key):
+        import hashlib
+        digest = hashlib.sha1(
+            (self.function.__qualname__ + key).encode()).hexdigest()
+        return os.path.join(self.store, "%s-%s.pickle" % (
+            self.function.__name__, digest))
+
+    def evict(self):
+        """remove the oldest results until the store fits ``max_bytes``"""
+        try:
+            entries = sorted(
+                (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in os.scandir(self.store)
+                if entry.name.endswith(".pickle"))
+        except OSError:
+            return
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+
+def memoize(ttl=None, maxsize=128, store=None, max_bytes=None):
+    """
+    Cache the return value of an idempotent command.
+
+    The result is looked up by the arguments of the command, after their
+    conversion to the annotated types, so ``add 1 2`` and ``add a=1 b=2``
+    share it. Only the return value is cached, not what the command
+    prints. Iterators are stored as lists.
+
+    Args:
+        ttl (float): the seconds a result is used, forever if None.
+        maxsize (int): the number of results kept in memory by a shell.
+        store (str): a directory keeping the results between one-shot
+        runs of a ``mach1`` program. Without it, results are cached in
+        memory.
+        max_bytes (int): remove the oldest results when the files in
+        ``store`` are larger.
+    """
+    def decorator(function):
+        import functools
+        import inspect
+        memo = _Memo(function, ttl, maxsize, store, max_bytes)
+
+        def remember(args, key, value):
+            if not isinstance(value, (str, bytes, dict)) and (
+                    hasattr(value, '__next__')):
+                value = list(value)
+            memo.put(args[0], key, value)
+            return value
+
+        if inspect.iscoroutinefunction(function):
+            async def wrapper(*args, **kwargs):
+                key = memo.key(args, kwargs)
+                value = memo.get(args[0], key)
+                if value is _missing:
+                    value = remember(args, key,
+                                     await function(*args, **kwargs))
+                return value
+        else:
+            def wrapper(*args, **kwargs):
+                key = memo.key(args, kwargs)
+                value = memo.get(args[0], key)
+                if value is _missing:
+                    value = remember(args, key, function(*args, **kwargs))
+                return value
+
+        functools.update_wrapper(wrapper, function)
+        # the arguments of the command are read from the signature
+        wrapper.__signature__ = memo.signature
+        wrapper.memo = memo
+        return wrapper
+    return decorator
+
+
+def _complete(inst, result, session=True):
+    """
+    Finish a command: run the coroutine returned by an ``async def``
+    command and write the items of an iterable result.
+
+    Shells run coroutines in the event loop of the session, so that
+    objects bound to the loop survive until the next command. With
+    ``session=False``, or for ``mach1`` classes, they run in a new loop.
+    """
+    return _write_items(inst, _await(inst, result, session), session)
+
+
+def _await(inst, result, session=True):
+    """run ``result`` to completion if it is a coroutine, see _complete"""
+    if not hasattr(result, '__await__'):
+        return result
+    if session and isinstance(inst, _Shell):
+        return inst._event_loop().run_until_complete(result)
+    # asyncio.run needs Python 3.7
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(result)
+    finally:
+        _close_event_loop(loop)
+
+
+def _close_event_loop(loop):
+    """finalize the asynchronous generators of ``loop`` and close it"""
+    if hasattr(loop, 'shutdown_asyncgens'):  # Python 3.6
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+# The number of items joined for one write of a streamed result
+STREAM_CHUNK = 1024
 
-    p = inst.parser.parse_args(args=args)
+
+class _ItemWriter:
+    """
+    Write the items of a command result, one per line.
+
+    Items are joined in chunks of ``STREAM_CHUNK`` lines for each write.
+    If the class of the command defines ``flush_every``, the stream is
+    flushed after every ``flush_every`` items instead.
+    """
+
+    def __init__(self, inst):
+        self.stream = inst.stdout if isinstance(inst, _Shell) else sys.stdout
+        self.flush_every = getattr(inst, 'flush_every', None)
+        self.chunk = []
+
+    def write_all(self, items):
+        size = self.flush_every or STREAM_CHUNK
+        chunk = self.chunk
+        append = chunk.append
+        for item in items:
+            append("%s\n" % (item,))
+            if len(chunk) >= size:
+                self.write()
+        self.write()
+
+    async def write_all_async(self, items):
+        size = self.flush_every or STREAM_CHUNK
+        async for item in items:
+            self.chunk.append("%s\n" % (item,))
+            if len(self.chunk) >= size:
+                self.write()
+        self.write()
+
+    def write(self):
+        if self.chunk:
+            self.stream.write("".join(self.chunk))
+            self.chunk.clear()
+            if self.flush_every:
+                self.stream.flush()
+
+
+def _write_items(inst, result, session=True):
+    """
+    Stream ``result`` to the output if it is an iterable, like a list or
+    a (async) generator. Strings, bytes and mappings are not streamed.
+
+    Returns:
+        None if ``result`` was written, otherwise ``result``.
+    """
+    if result is None or isinstance(result, (str, bytes, bytearray, dict)):
+        return result
+    if hasattr(result, '__aiter__'):
+        _complete(inst, _ItemWriter(inst).write_all_async(result), session)
+    elif hasattr(result, '__iter__'):
+        _ItemWriter(inst).write_all(result)
+    else:
+        return result
+
+
+def _call(inst, func, args, kwargs, phases, name=None, session=True,
+          timings=False, profile=None, profiler=None):
+    """
+    Call a command, with the profiler if ``profile`` is given, and
+    report the duration of ``phases`` and of the call if ``timings`` is
+    true. The call is recorded as the command ``name`` in the metrics of
+    ``inst``, if it has them.
+
+    Args:
+        profile (str): the file to write the cProfile of the call to.
+        profiler: the ``cProfile.Profile`` to run the call with, a new
+        one by default.
+    """
+    started = time.perf_counter()
+    failed = True
+    try:
+        if not profile:
+            result = _complete(inst, func(*args, **kwargs), session)
+        else:
+            if profiler is None:
+                import cProfile
+                profiler = cProfile.Profile()
+            try:
+                result = profiler.runcall(
+                    lambda: _complete(inst, func(*args, **kwargs), session))
+            finally:
+                profiler.dump_stats(profile)
+        failed = False
+        return result
+    except SystemExit as e:
+        failed = bool(e.code)
+        raise
+    finally:
+        metrics = getattr(inst, '_metrics', None)
+        if metrics is not None:
+            metrics.observe(name or func.__name__,
+                            time.perf_counter() - started, failed)
+        if timings:
+            phases.append(('execute', time.perf_counter() - started))
+            sys.stderr.write("timings: %s\n" % ", ".join(
+                "%s %.3f ms" % (phase, seconds * 1000)
+                for phase, seconds in phases))
+
+
+# The upper bounds, in seconds, of the buckets of the latency histograms
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0, 10.0)
+
+
+class _CommandMetrics:
+    """the calls, errors and latency histogram of one command"""
+
+    __slots__ = ('count', 'errors', 'seconds', 'buckets')
+
+    def __init__(self, size):
+        self.count = self.errors = 0
+        self.seconds = 0.0
+        # the calls in each bucket, the last one is beyond the last bound
+        self.buckets = [0] * size
+
+
+class Metrics:
+    """
+    Count the calls and the errors of each command and keep histograms of
+    their latency in fixed buckets, so recording a call costs a few
+    additions whatever the number of calls.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        import threading
+        self.bounds = tuple(buckets)
+        self.commands = {}
+        self.lock = threading.Lock()
+        self.exports = set()
+
+    def observe(self, name, seconds, failed=False):
+        """record a call of the command ``name`` which took ``seconds``"""
+        from bisect import bisect_left
+        index = bisect_left(self.bounds, seconds)
+        with self.lock:
+            command = self.commands.get(name)
+            if command is None:
+                command = self.commands[name] = _CommandMetrics(
+                    len(self.bounds) + 1)
+            command.count += 1
+            command.errors += failed
+            command.seconds += seconds
+            command.buckets[index] += 1
+
+    def _cumulative(self, command):
+        """the calls up to each bound, as ``(bound, calls)``"""
+        total, counts = 0, []
+        for bound, calls in zip(self.bounds + ('+Inf',), command.buckets):
+            total += calls
+            counts.append((bound, total))
+        return counts
+
+    def to_json(self):
+        """the metrics as a dict, with cumulative histogram buckets"""
+        with self.lock:
+            return {name: {'count': command.count, 'errors': command.errors,
+                           'seconds': command.seconds,
+                           'buckets': {str(bound): calls for bound, calls
+                                       in self._cumulative(command)}}
+                    for name, command in sorted(self.commands.items())}
+
+    def to_prometheus(self, prefix="mach"):
+        """the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            commands = sorted(self.commands.items())
+            for metric, kind, help_, value in (
+                    ('calls_total', 'counter', 'Calls of each command.',
+                     lambda command: command.count),
+                    ('errors_total', 'counter', 'Failed calls of each '
+                     'command.', lambda command: command.errors)):
+                lines += ["# HELP %s_command_%s %s" % (prefix, metric, help_),
+                          "# TYPE %s_command_%s %s" % (prefix, metric, kind)]
+                lines += ['%s_command_%s{command="%s"} %d' % (
+                    prefix, metric, name, value(command))
+                    for name, command in commands]
+
+            metric = "%s_command_duration_seconds" % prefix
+            lines += ["# HELP %s Latency of each command." % metric,
+                      "# TYPE %s histogram" % metric]
+            for name, command in commands:
+                lines += ['%s_bucket{command="%s",le="%s"} %d' % (
+                    metric, name, bound, calls)
+                    for bound, calls in self._cumulative(command)]
+                lines.append('%s_sum{command="%s"} %r' % (
+                    metric, name, command.seconds))
+                lines.append('%s_count{command="%s"} %d' % (
+                    metric, name, command.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """a table of the calls, errors and latency of each command"""
+        rows = [("command", "calls", "errors", "mean ms", "p95 ms")]
+        with self.lock:
+            for name, command in sorted(self.commands.items()):
+                # the upper bound of the bucket holding the 95th percentile
+                rank = command.count * 0.95
+                p95 = next(bound for bound, calls in self._cumulative(command)
+                           if calls >= rank)
+                rows.append((name, str(command.count), str(command.errors),
+                             "%.2f" % (command.seconds / command.count * 1000),
+                             "<= %g" % (p95 * 1000) if p95 != '+Inf'
+                             else "> %g" % (self.bounds[-1] * 1000)))
+        widths = [max(len(row[i]) for row in rows) for i in range(5)]
+        return "".join("  ".join(cell.ljust(width) for cell, width
+                                 in zip(row, widths)).rstrip() + "\n"
+                       for row in rows)
+
+    def write(self, path):
+        """write the metrics to ``path``, as JSON for a ``.json`` file"""
+        if path.endswith('.json'):
+            import json
+            text = json.dumps(self.to_json(), indent=2) + "\n"
+        else:
+            text = self.to_prometheus()
+        _replace_file(path, lambda f: f.write(text))
+
+    def write_at_exit(self, path):
+        """write the metrics to ``path`` when the program exits"""
+        if path not in self.exports:
+            import atexit
+            self.exports.add(path)
+            atexit.register(self.write, path)
+
+
+def _show_stats(self):
+    """show the calls, errors and latency of the commands: stats"""
+    self.stdout.write(self._metrics.summary())
+
+
+class _FastPath:
+    """
+    A parser for the arguments of a command with a simple signature:
+    ``str``, ``int`` and ``float`` arguments, ``bool`` flags and
+    ``**kwargs`` in JSON. It accepts the arguments exactly as given by
+    ``add_arguments``, and gives up on anything else.
+    """
+
+    __slots__ = ('positionals', 'options', 'defaults')
+
+    def __init__(self, positionals, options, defaults):
+        self.positionals = positionals
+        self.options = options
+        self.defaults = defaults
+
+    @classmethod
+    def create(cls, spec):
+        """the fast path of ``spec`` or None if argparse is needed"""
+        positionals, options, defaults = [], {}, {}
+        count = len(spec.defaults) if spec.defaults else 0
+        reversed_defaults = list(reversed(spec.defaults or ()))
+        # the arguments in the order add_arguments adds them
+        for idx, name in enumerate(reversed(spec.args)):
+            type_ = spec.annotations.get(name)
+            type_name = getattr(type_, '__name__', None)
+            if type_ is None:
+                convert = str
+            elif type_name == 'bool' and type_ is bool:
+                convert = None
+            elif _supported_types.get(type_name) is type_:
+                convert = type_
+            else:
+                return None
+
+            if idx >= count:
+                if convert is None:
+                    return None
+                positionals.append((name, convert))
+                continue
+            default = reversed_defaults[idx]
+            if isinstance(default, str) and convert not in (None, str):
+                try:
+                    default = convert(default)
+                except (TypeError, ValueError):
+                    return None
+            defaults[name] = default
+            strings = ["-" + name] if len(name) == 1 else \
+                ["--" + name, "-" + name[0]]
+            for string in strings:
+                if string in options or string == "-h":
+                    return None
+                options[string] = name, convert
+        if spec.varkw:
+            string = "--" + spec.varkw
+            if string in options:
+                return None
+            options[string] = spec.varkw, str
+            defaults[spec.varkw] = None
+        return cls(positionals, options, defaults)
+
+    def parse(self, tokens):
+        """the values of the arguments in ``tokens``, or None"""
+        values = dict(self.defaults)
+        positionals = []
+        tokens = iter(tokens)
+        for token in tokens:
+            if not token.startswith("-"):
+                positionals.append(token)
+                continue
+            option = self.options.get(token)
+            if option is None:
+                return None
+            dest, convert = option
+            if convert is None:
+                values[dest] = True
+                continue
+            value = next(tokens, "-")
+            if value.startswith("-"):
+                return None
+            try:
+                values[dest] = convert(value)
+            except (TypeError, ValueError):
+                return None
+
+        if len(positionals) != len(self.positionals):
+            return None
+        try:
+            for (dest, convert), value in zip(self.positionals, positionals):
+                values[dest] = convert(value)
+        except (TypeError, ValueError):
+            return None
+        return values
+
+
+def _global_defaults(parser):
+    """the values argparse gives the options of ``parser`` not given"""
+    defaults = {}
+    for action in parser._actions:
+        if action.dest is argparse.SUPPRESS or \
+                action.default is argparse.SUPPRESS:
+            continue
+        default = action.default
+        if isinstance(default, str) and action.type is not None:
+            default = parser._get_value(action, default)
+        defaults[action.dest] = default
+    for dest, default in parser._defaults.items():
+        defaults.setdefault(dest, default)
+    return defaults
+
+
+def _fast_parse(parser, argv):
+    """
+    Parse ``argv`` without argparse when it is a command of ``parser``
+    followed by simple arguments, see :class:`_FastPath`.
+
+    Returns:
+        the namespace argparse would return, or None to use argparse,
+        e.g. for ``--help``, errors and global options.
+    """
+    signatures = getattr(parser, 'signatures', None)
+    if not argv or not signatures or argv[0] not in signatures:
+        return None
+    prefix = parser.fromfile_prefix_chars
+    if prefix and any(arg[:1] in prefix for arg in argv):
+        return None
+
+    name = argv[0]
+    fast_path = parser.fast_paths.get(name, _missing)
+    if fast_path is _missing:
+        kls, function, sig = signatures[name]
+        fast_path = parser.fast_paths[name] = _FastPath.create(
+            command_spec(kls, name, function, sig))
+    if fast_path is None:
+        return None
+    values = fast_path.parse(argv[1:])
+    if values is None:
+        return None
+
+    defaults = parser.__dict__.get('global_defaults')
+    if defaults is None:
+        defaults = parser.global_defaults = _global_defaults(parser)
+    namespace = argparse.Namespace(**defaults)
+    namespace.cmd = name
+    for dest, value in values.items():
+        setattr(namespace, dest, value)
+    return namespace
+
+
+def _command_args(inst, p):
+    """find the method of the command selected in ``p`` and its arguments"""
+    spec = command_spec(type(inst), p.cmd)
+    kwargs = {}
+    if spec.varkw and getattr(p, spec.varkw):
+        import json
+        kwargs = json.loads(getattr(p, spec.varkw))
+    return (types.MethodType(spec.func, inst),
+            [getattr(p, arg) for arg in spec.args], kwargs)
+
+
+def _positive_int(text):
+    """an argparse type for numbers greater than zero"""
+    try:
+        number = int(text)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "%r is not a positive integer" % text)
+    return number
+
+
+def _add_fan_out_arguments(parser):
+    parser.add_argument("--map", metavar="FILE", type=argparse.FileType('r'),
+                        help="run the command once for every line of FILE, "
+                             "which holds the arguments of one run; "
+                             "- for stdin")
+    parser.add_argument("--jobs", metavar="N", type=_positive_int,
+                        default=4,
+                        help="the number of runs of --map executed at once")
+    parser.add_argument("--unordered", action='store_true',
+                        help="print the output of the runs of --map as "
+                             "they finish")
+
+
+class _ThreadOutput:
+    """A stream which collects the writes of each thread separately"""
+
+    def __init__(self, stream, local=None):
+        import threading
+        self.stream = stream
+        self.local = local or threading.local()
+
+    def write(self, s):
+        return (getattr(self.local, 'target', None) or self.stream).write(s)
+
+    def flush(self):
+        (getattr(self.local, 'target', None) or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self, func, *args, buffer=None):
+        """
+        Call ``func`` and collect what it writes in ``buffer``, a new
+        ``StringIO`` by default.
+
+        Returns:
+            the output and the exception raised by ``func`` or None.
+        """
+        self.local.target = buffer = buffer or io.StringIO()
+        error = None
+        try:
+            func(*args)
+        except SystemExit as e:
+            if e.code:
+                error = e
+        except Exception as e:
+            error = e
+        finally:
+            self.local.target = None
+        return buffer.getvalue(), error
+
+
+class _Job:
+    """A command of a shell running in the background"""
+
+    def __init__(self, number, line):
+        self.number, self.line = number, line
+        self.output = io.StringIO()
+        # the exception of the command, or why it could not be dispatched
+        self.error = self.future = None
+        self.reported = False
+
+    @property
+    def status(self):
+        future = self.future
+        if future.cancelled():
+            return 'cancelled'
+        if not future.done():
+            return 'running' if future.running() else 'queued'
+        return 'done' if self.error is None else 'failed'
+
+
+class _Jobs:
+    """
+    The background jobs of a shell, run in a pool of ``max_jobs``
+    threads. While there are jobs, the output of the shell and of
+    ``print`` is collected separately for each job.
+    """
+
+    def __init__(self, shell):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=shell.max_jobs)
+        self.jobs = {}
+        self.count = 0
+        self.local = threading.local()
+        self.streams = shell.stdout, sys.stdout
+        shell.stdout = _ThreadOutput(shell.stdout, self.local)
+        sys.stdout = shell.stdout if sys.stdout is self.streams[0] else \
+            _ThreadOutput(sys.stdout, self.local)
+
+    def submit(self, shell, line):
+        self.count += 1
+        job = self.jobs[self.count] = _Job(self.count, line)
+        job.future = self.pool.submit(self.run, shell, job)
+        return job
+
+    def run(self, shell, job):
+        self.local.job = job
+        try:
+            _, error = shell.stdout.capture(shell.onecmd, job.line,
+                                            buffer=job.output)
+            if error is not None:
+                job.error = error
+        finally:
+            self.local.job = None
+
+    def wait(self, shell, job):
+        """wait for ``job``, print its output and forget it"""
+        from concurrent.futures import CancelledError
+        try:
+            job.future.result()
+        except CancelledError:
+            pass
+        self.jobs.pop(job.number, None)
+        shell.stdout.write(job.output.getvalue())
+        if job.error is not None:
+            shell.stdout.write("[%d] failed: %s\n" % (job.number, job.error))
+
+    def report(self, shell):
+        """announce the jobs which finished since the last command"""
+        for job in self.jobs.values():
+            if not job.reported and job.future.done():
+                job.reported = True
+                shell.stdout.write("[%d] %-9s %s\n" % (
+                    job.number, job.status, job.line))
+
+    def close(self, shell, cancel=True):
+        if cancel:
+            for job in self.jobs.values():
+                job.future.cancel()
+        self.pool.shutdown(wait=True)
+        if not cancel:
+            self.report(shell)
+        for job in list(self.jobs.values()):
+            if not job.future.cancelled():
+                self.wait(shell, job)
+        if shell.stdout.stream is self.streams[0]:
+            shell.stdout = self.streams[0]
+        if getattr(sys.stdout, 'local', None) is self.local:
+            sys.stdout = self.streams[1]
+
+
+def _run_mapped(inst, p):
+    func, args, kwargs = _command_args(inst, p)
+    _complete(inst, func(*args, **kwargs), session=False)
+
+
+def _fan_out(inst, argv, opts):
+    """
+    Run the command in ``argv`` once for every line in ``opts.map``.
+
+    The lines are parsed in the calling thread and the commands run in a
+    pool of ``opts.jobs`` threads. At most twice as many runs are pending,
+    their output is buffered and printed in the order of the lines, or as
+    the runs finish with ``opts.unordered``.
+    """
+    import shlex
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    output = _ThreadOutput(sys.stdout)
+    failures = []
+    pending = []
+    total = 0
+
+    def failed(lineno, line, error):
+        failures.append(lineno)
+        sys.stderr.write("line %d: %s: %s\n" % (lineno, line, error))
+
+    def report(lineno, line, future):
+        out, error = future.result()
+        output.stream.write(out)
+        if isinstance(error, SystemExit):
+            failed(lineno, line, "exit status %s" % error.code)
+        elif error is not None:
+            failed(lineno, line, "%s: %s" % (type(error).__name__, error))
+
+    def drain(limit):
+        while len(pending) > limit:
+            if not opts.unordered:
+                report(*pending.pop(0))
+                continue
+            done, _ = wait([future for _, _, future in pending],
+                           return_when=FIRST_COMPLETED)
+            for item in [item for item in pending if item[2] in done]:
+                pending.remove(item)
+                report(*item)
+
+    try:
+        with _RedirectOutput(inst, output, wrapped=output.stream), \
+                ThreadPoolExecutor(max_workers=opts.jobs) as pool:
+            for lineno, line in enumerate(opts.map, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                total += 1
+                try:
+                    p = inst.parser.parse_args(argv + shlex.split(line))
+                except (SystemExit, ValueError):
+                    failed(lineno, line, "invalid arguments")
+                    continue
+                if not p.cmd:
+                    failed(lineno, line, "no command given")
+                    continue
+                pending.append((lineno, line, pool.submit(
+                    output.capture, _run_mapped, inst, p)))
+                drain(2 * opts.jobs)
+            drain(0)
+    finally:
+        if opts.map is not sys.stdin:
+            opts.map.close()
+
+    if failures:
+        sys.stderr.write("%d of %d runs failed\n" % (len(failures), total))
+        sys.exit(1)
+    return True
+
+
+class _Frames:
+    """
+    Write the output of a command to a client of the daemon, as JSON
+    lines ``{"stdout": text}`` or ``{"stderr": text}``. Text is sent at
+    the end of a line or when flushed.
+    """
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.pending = []
+
+    def write(self, s):
+        self.pending.append(s)
+        if "\n" in s:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.pending:
+            _send_frame(self.wfile, {self.name: "".join(self.pending)})
+            self.pending = []
+
+
+def _send_frame(wfile, frame):
+    import json
+    wfile.write(json.dumps(frame).encode() + b"\n")
+    wfile.flush()
+
+
+def _run_request(inst, argv):
+    """run ``argv`` like ``_run1`` and return the exit status"""
+    try:
+        _run1(inst, argv, served=True)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write("%s\n" % e.code)
+        return 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def serve(inst, path, idle_timeout=None):
+    """
+    Run the commands of ``inst`` for clients of the Unix socket ``path``.
+
+    A client sends one JSON line ``{"argv": [...]}``. The daemon runs the
+    argument vector with ``_run1`` in a thread of its own and streams the
+    output as ``{"stdout": text}`` and ``{"stderr": text}`` lines, followed
+    by ``{"exit": status}``. Use :func:`client` to connect. The standard
+    input of the client is not forwarded.
+
+    Args:
+        idle_timeout (float): stop after this many seconds without a
+        client. ``None`` serves until interrupted.
+    """
+    import json
+    import socket
+    import socketserver
+    import threading
+
+    stdout, stderr = _ThreadOutput(sys.stdout), _ThreadOutput(sys.stderr)
+    lock = threading.Lock()
+    state = {'active': 0, 'last': time.monotonic()}
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            with lock:
+                state['active'] += 1
+            try:
+                request = json.loads(self.rfile.readline().decode())
+                out = stdout.local.target = _Frames(self.wfile, 'stdout')
+                err = stderr.local.target = _Frames(self.wfile, 'stderr')
+                try:
+                    code = _run_request(inst, request['argv'])
+                finally:
+                    stdout.local.target = stderr.local.target = None
+                out.flush()
+                err.flush()
+                _send_frame(self.wfile, {'exit': code})
+            finally:
+                with lock:
+                    state['active'] -= 1
+                    state['last'] = time.monotonic()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # left over by a daemon which did not exit cleanly
+            os.unlink(path)
+        else:
+            raise OSError("a daemon is already serving on %s" % path)
+        finally:
+            probe.close()
+
+    sys.stderr = stderr
+    try:
+        with _RedirectOutput(inst, stdout, wrapped=stdout.stream), \
+                Server(path, Handler) as server:
+            if not idle_timeout:
+                server.serve_forever()
+                return
+            server.timeout = min(idle_timeout, 1.0)
+            while True:
+                server.handle_request()
+                with lock:
+                    if not state['active'] and (
+                            time.monotonic() - state['last'] > idle_timeout):
+                        return
+    finally:
+        sys.stderr = stderr.stream
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def client(path, argv):
+    """
+    Run ``argv`` in the daemon serving on ``path``, write its output to
+    ``sys.stdout`` and ``sys.stderr`` and return its exit status.
+    """
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile('rwb') as f:
+            _send_frame(f, {'argv': list(argv)})
+            for line in f:
+                frame = json.loads(line.decode())
+                if 'exit' in frame:
+                    return frame['exit']
+                for name, text in frame.items():
+                    stream = sys.stdout if name == 'stdout' else sys.stderr
+                    stream.write(text)
+                    stream.flush()
+    raise ConnectionError("the daemon on %s closed the connection" % path)
+
+
+def _command(inst, name):
+    """the dispatch record of the command ``name`` of ``inst`` or None"""
+    # the commands of the class, not the groups nor the methods of Cmd
+    if not isinstance(name, str) or name not in inst.parser.signatures:
+        return None
+    return command_spec(type(inst), name)
+
+
+async def _collect(items):
+    # no asynchronous comprehension, it needs Python 3.6
+    collected = []
+    async for item in items:
+        collected.append(item)
+    return collected
+
+
+def _dispatch_record(inst, record):
+    """
+    Run the command of a JSON lines request and return the response.
+    The arguments are checked like the ``name=value`` options of
+    ``Mach.onecmd``.
+    """
+    command = _command(inst, record.get('cmd'))
+    if command is None:
+        raise LookupError("Unknown command %s" % record.get('cmd'))
+
+    args = record.get('args', [])
+    if not isinstance(args, list):
+        raise TypeError("args must be an array")
+    kwargs = record.get('kwargs', {})
+    if not isinstance(kwargs, dict):
+        raise TypeError("kwargs must be an object")
+    args, kwargs = list(args), dict(kwargs)
+    for name in kwargs:
+        if name not in command.keywords:
+            raise TypeError("Unknown option %s" % name)
+    if command.varkw and command.varkw in kwargs:
+        kwargs.update(kwargs.pop(command.varkw))
+    if command.nargs is not None and len(args) > command.nargs:
+        raise TypeError("%s takes at most %d arguments" % (
+            record['cmd'], command.nargs))
+
+    converters = command.converters
+    if converters:
+        args = [converters[name](val)
+                if name in converters and isinstance(val, (str, list))
+                else val
+                for name, val in zip(command.args, args)] + \
+            args[len(command.args):]
+        for name in converters.keys() & kwargs.keys():
+            if isinstance(kwargs[name], (str, list)):
+                kwargs[name] = converters[name](kwargs[name])
+
+    result = _await(inst, command.func(inst, *args, **kwargs))
+    if hasattr(result, '__aiter__'):
+        result = _await(inst, _collect(result))
+    elif hasattr(result, '__iter__') and not isinstance(
+            result, (str, bytes, bytearray, dict)):
+        result = list(result)
+    return result
+
+
+def run_jsonl(inst, lines, out):
+    """
+    Run the commands of ``inst`` requested by JSON ``lines``.
+
+    Each line holds one request ``{"cmd": name, "args": [...],
+    "kwargs": {...}}``. For each request one JSON line is written to
+    ``out``: ``{"result": value}`` or ``{"error": {"type": ...,
+    "message": ...}}``. Iterable results are returned as lists, values
+    which are not JSON are returned as strings. What the command prints
+    is returned as ``"output"``. An ``"id"`` of the request is copied to
+    the response.
+
+    Returns:
+        the number of failed requests.
+    """
+    import json
+
+    failures = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        output = io.StringIO()
+        response = {}
+        try:
+            record = json.loads(line)
+            if 'id' in record:
+                response['id'] = record['id']
+            with _RedirectOutput(inst, output):
+                response['result'] = _dispatch_record(inst, record)
+        except Exception as e:
+            failures += 1
+            response['error'] = {'type': type(e).__name__, 'message': str(e)}
+        if output.getvalue():
+            response['output'] = output.getvalue()
+        out.write(json.dumps(response, default=str) + "\n")
+        out.flush()
+    return failures
+
+
+# The options which take over the process, or act when it exits, a daemon
+# does not run them for its clients
+_PROCESS_OPTIONS = (('map', '--map'), ('shell', '--shell'),
+                    ('serve', '--serve'), ('batch', '--batch'),
+                    ('jsonl', '--jsonl'), ('metrics', '--metrics'))
+
+
+def _run1(inst, args=None, served=False):
+
+    started = time.perf_counter()
+    if getattr(inst.parser, 'fan_out', False):
+        fan_out = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+        _add_fan_out_arguments(fan_out)
+        opts, argv = fan_out.parse_known_args(
+            sys.argv[1:] if args is None else args)
+        if opts.map and served:
+            inst.parser.error("--map can not be run by a daemon")
+        if opts.map:
+            return _fan_out(inst, argv, opts)
+
+    argv = sys.argv[1:] if args is None else args
+    p = _fast_parse(inst.parser, argv) or inst.parser.parse_args(args=argv)
+
+    if served:
+        for name, option in _PROCESS_OPTIONS:
+            if getattr(p, name, None):
+                inst.parser.error("%s can not be run by a daemon" % option)
+
+    # a daemon runs the requests of its clients concurrently with the same
+    # instance, the options of a request are kept out of it
+    timings = getattr(p, 'timings', False)
+    profile = getattr(p, 'profile', None)
+    if not served:
+        # for the commands of a shell or a batch
+        inst._timings, inst._profile = timings, profile
+
+    # the metrics of a shell, a server or a batch are written on exit too
+    if getattr(p, 'metrics', None):
+        inst._metrics.write_at_exit(p.metrics)
 
     if getattr(p, 'shell', False):
         inst.cmdloop()
@@ -262,22 +2791,64 @@ def _run1(inst, args=None):
                 else:
                     func()
 
+    if getattr(p, 'serve', None):
+        serve(inst, p.serve, p.idle_timeout)
+        return True
+
+    if getattr(p, 'completion', None):
+        sys.stdout.write(completion_script(inst.parser, p.completion))
+        if inst.parser.completion_files:
+            _write_completions(inst.parser, [p.completion])
+        return True
+
+    if getattr(p, 'jsonl', False):
+        if run_jsonl(inst, sys.stdin, sys.stdout):
+            sys.exit(1)
+        return True
+
+    if getattr(p, 'batch', None):
+        try:
+            failures = inst.run_batch(p.batch,
+                                      stop_on_error=not p.keep_going)
+        finally:
+            inst._close_loop()
+            if p.batch is not sys.stdin:
+                p.batch.close()
+        if failures:
+            sys.stderr.write("%d command(s) failed:\n" % len(failures))
+            for lineno, line, error in failures:
+                sys.stderr.write("  line %d: %s: %s\n" % (lineno, line, error))
+            sys.exit(1)
+        return True
+
+    target = inst
+    if getattr(p, _GROUP, None):
+        target, group_parser = _resolve_group(inst, getattr(p, _GROUP))
+        if not p.cmd:
+            group_parser.print_help()
+            return True
+
     if p.cmd:
-        func_args_kwargs = inspect.getfullargspec(getattr(inst, p.cmd))
-        args = func_args_kwargs.args
-        args.pop(args.index("self"))
-        if func_args_kwargs.varkw:
-            kwargs = getattr(p, func_args_kwargs.varkw)
-            if kwargs:
-                kwargs = json.loads(kwargs)
-            else:
-                kwargs = {}
-            func = getattr(inst, p.cmd)
-            func(*(getattr(p, arg) for arg in args), **kwargs)
+        func, args, kwargs = _command_args(target, p)
+
+        if timings or profile or getattr(inst, '_metrics', None):
+            # argparse converts the values while parsing
+            phases = [('parse', time.perf_counter() - started)]
+            parser = inst.parser
+            if timings and not parser.build_reported:
+                parser.build_reported = True
+                phases.insert(0, ('build', parser.build_seconds))
+                if parser.startup_seconds is not None:
+                    phases.insert(0, ('startup', parser.startup_seconds))
+            _call(inst, func, args, kwargs, phases, name=p.cmd,
+                  session=not served, timings=timings, profile=profile)
         else:
-            func = getattr(inst, p.cmd)
-            func(*(getattr(p, arg) for arg in args))
-            return True
+            # the requests of a daemon run at the same time, each in a loop
+            # of its own
+            _complete(inst, func(*args, **kwargs), session=not served)
+        if isinstance(inst, _Shell) and not served:
+            inst._close_loop()
+        return True
 
     if inst.parser.auto_help:
         inst.parser.print_help()
@@ -289,30 +2860,50 @@ def _run2(inst):  # pragma: no coverage
         inst.cmdloop()
 
 
-def mach1(auto_help=True):  # pragma: no coverage
+def mach1(auto_help=True, spec_cache=None, timings=False, fan_out=False,
+          daemon=False, jsonl=False, completion=False,
+          args_file=False, metrics=False):  # pragma: no coverage
 
     def real_decorator(callable_, *args, **kwargs):
 
         def wrapper(*args, **kwargs):
-            kls = _mach(callable_, explicit=False, auto_help=auto_help)
+            kls = _mach_cached(callable_, explicit=False, auto_help=auto_help,
+                               spec_cache=spec_cache, timings=timings,
+                               fan_out=fan_out, daemon=daemon, jsonl=jsonl,
+                               completion=completion, args_file=args_file,
+                               metrics=metrics)
             kls.run = _run1
             return kls(*args, **kwargs)
 
+        wrapper.__wrapped__ = callable_
         return wrapper
 
     return real_decorator
 
 
-def mach2(explicit=False):
+def mach2(explicit=False, spec_cache=None, timings=False, fan_out=False,
+          daemon=False, jsonl=False, completion=False, args_file=False,
+          metrics=False):
 
     def real_decorator(callable_, *args, **kwargs):
 
         def wrapper(*args, **kwargs):
-            kls = _mach(callable_, add_do=True, explicit=explicit)
+            kls = _mach_cached(callable_, add_do=True, explicit=explicit,
+                               spec_cache=spec_cache, timings=timings,
+                               fan_out=fan_out, daemon=daemon, jsonl=jsonl,
+                               completion=completion, args_file=args_file,
+                               metrics=metrics)
             kls._run1 = _run1
             kls.run = _run2
             return kls(*args, **kwargs)
 
+        wrapper.__wrapped__ = callable_
         return wrapper
 
     return real_decorator
+
+
+if __name__ == '__main__':  # pragma: no coverage
+    if len(sys.argv) < 2:
+        sys.exit("usage: python -m mach SOCKET [ARGS ...]")
+    sys.exit(client(sys.argv[1], sys.argv[2:]))
@@ -4,13 +4,21 @@
 """Tests for `mach` module."""
 import argparse
 import cmd
+import inspect
+import os
+import subprocess
+import sys
+import threading
+import time
 
 from io import StringIO
+from typing import List, Tuple
 from unittest import mock
 
 
 import pytest
 
+import mach
 
 from examples.greet import Hello
 from examples.calc import Calculator
@@ -98,7 +106,7 @@ def test_uftpd():
      ("ls /foo/", "Files in /foo/"),
      ("help", """Documented commands (type help <topic>):
 ========================================
-connect  exit  help  login  ls"""),
+cancel  connect  exit  help  jobs  login  ls  wait"""),
      ("connect foo=21", "Unknown option foo"),
      ("""connect foo.example.com 21 opts='{"user": "oz123", "password": "s3kr35"}""",  # noqa: E501
       """connect foo.example.com 21 opts='{"user": "oz123", "password": "s3kr35"}: No closing quotation"""),  # noqa: E501
@@ -125,3 +133,1262 @@ def test_bolt(input, output):
             assert fakeOutput.getvalue().strip() == output
     except SystemExit:
         pass
+
+
+def test_build_cache():
+    first, second = Calc2(), Calc2()
+
+    assert type(first) is type(second)
+    assert first.parser is second.parser
+    assert Calculator().parser is Calculator().parser
+
+    mach.clear_cache(Calc2)
+    third = Calc2()
+    assert type(third) is not type(first)
+    assert third.parser is not first.parser
+    assert Calculator().parser is Calculator().parser
+
+    parser = Calculator().parser
+    mach.clear_cache()
+    assert Calculator().parser is not parser
+
+
+def test_build_cache_init_options():
+    # Bolt adds global options in __init__ to the shared parser
+    for _ in range(3):
+        with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+            Bolt().run(["-v", "3", "clone"])
+            assert fakeOutput.getvalue().strip() == (
+                "Clonning with verbosity level of 3")
+
+
+def test_lazy_subparsers():
+    mach.clear_cache()
+    calc = Calc2()
+    parsers = calc.parser._subparsers._group_actions[0].choices
+
+    assert not any(isinstance(dict.__getitem__(parsers, name),
+                              argparse.ArgumentParser) for name in parsers)
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        calc.parser.print_help()
+        assert 'adds two numbers and prints the result' in \
+            fakeOutput.getvalue()
+
+    def built():
+        return [name for name in parsers if isinstance(
+            dict.__getitem__(parsers, name), argparse.ArgumentParser)]
+
+    # simple arguments take the fast path, which builds no parser
+    with mock.patch('sys.stdout', new=StringIO()):
+        calc._run1(["add", "2", "4"])
+    assert built() == []
+
+    calc.parser.parse_args(["add", "2", "4"])
+    assert built() == ['add']
+    assert parsers['div'].prog.endswith(' div')
+
+
+def test_onecmd_dispatch_table():
+    ftpc = FTPClient(stdout=StringIO())
+    ftpc.onecmd("connect foo.example.com 21")
+
+    command = type(ftpc)._commands['connect']
+    assert command.args == ('host', 'port')
+    assert command.keywords == {'host', 'port', 'opts'}
+    assert command.converters == {'port': int}
+
+    with mock.patch('inspect.getfullargspec') as getfullargspec:
+        FTPClient(stdout=StringIO()).onecmd("connect foo.example.com 21")
+        assert not getfullargspec.called
+
+
+def test_onecmd_converts_types():
+    calc = Calc2(stdout=StringIO())
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        calc.onecmd('add 1 b=2')
+        assert '1 + 2 => 3' == fakeOutput.getvalue().strip()
+
+    calc.onecmd('add 1 x')
+    assert calc.stdout.getvalue().strip() == '*** Unknown syntax: add 1 x'
+
+
+def test_run_batch():
+    ftpc = FTPClient(stdout=StringIO())
+    script = ["connect a.example.com 21\n", "# a comment\n", "\n",
+              "moo\n", "ls /foo/\n"]
+
+    failures = ftpc.run_batch(script)
+    assert failures == [(4, 'moo', 'Unknown syntax')]
+    assert ftpc.stdout.getvalue() == (
+        "Connected to a.example.com:21\n*** Unknown syntax: moo\n")
+
+    ftpc = FTPClient(stdout=StringIO())
+    failures = ftpc.run_batch(script + ["connect foo=1"],
+                              stop_on_error=False)
+    assert [lineno for lineno, _, _ in failures] == [4, 6]
+    assert "Files in /foo/" in ftpc.stdout.getvalue()
+
+
+def test_batch_option(tmpdir):
+    script = tmpdir.join("script")
+    script.write("add 1 2\nadd 3 4\n")
+    calc = Calc2()
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        assert calc._run1(["--batch", str(script)])
+        assert fakeOutput.getvalue() == "1 + 2 => 3\n3 + 4 => 7\n"
+
+    script.write("add 1 2\nadd x 4\nadd 3 4\n")
+    with mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        with pytest.raises(SystemExit):
+            calc._run1(["--batch", str(script), "--keep-going"])
+        assert "line 2: add x 4: Unknown syntax" in fakeError.getvalue()
+
+
+def test_spec_cache(tmpdir):
+    kls = FTPClient.__wrapped__
+    spec_cache = str(tmpdir.join("cache"))
+
+    built = mach._mach(kls, add_do=True, spec_cache=spec_cache)
+    assert tmpdir.join("cache", "lftp.FTPClient.json").check()
+
+    with mock.patch('inspect.getmembers') as getmembers, \
+            mock.patch('inspect.getfullargspec') as getfullargspec:
+        cached = mach._mach(kls, add_do=True, spec_cache=spec_cache)
+        cached.parser.parse_args(["connect", "foo", "--port", "2121"])
+        assert not getmembers.called
+        assert not getfullargspec.called
+
+    assert cached.parser.parse_args(["connect", "foo", "-p", "2121"]) == \
+        built.parser.parse_args(["connect", "foo", "-p", "2121"])
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        cached().onecmd("help connect")
+        assert "host - the host IP or fqdn" in fakeOutput.getvalue()
+
+    # a changed source invalidates the cache
+    with mock.patch('mach._spec_key', return_value={'version': 'changed'}):
+        with mock.patch('inspect.getmembers',
+                        wraps=inspect.getmembers) as getmembers:
+            mach._mach(kls, add_do=True, spec_cache=spec_cache)
+            assert getmembers.called
+
+
+def test_spec_cache_unserializable_default(tmpdir):
+    import datetime
+
+    class Calendar:
+
+        def show(self, day=datetime.date(2020, 1, 1)):
+            """show a day"""
+            print(day)
+
+    spec_cache = str(tmpdir.join("cache"))
+    built = mach._mach(Calendar, spec_cache=spec_cache)
+    assert "show" in built.parser.subcommands.choices
+    assert not tmpdir.join("cache").check()
+
+
+IMPORT_BUDGET_US = 200000
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime and lazy Mach need Python 3.7")
+def test_import_time():
+    code = "\n".join([
+        "import sys",
+        "import mach",
+        "@mach.mach1()",
+        "class Calc:",
+        "    def add(self, a: int, b: int):",
+        "        'add two numbers'",
+        "        print(a + b)",
+        "assert not {'inspect', 'json', 'shlex', 'cmd'} & set(sys.modules)",
+        "Calc().run(['add', '1', '2'])",
+        "assert not {'json', 'shlex', 'cmd'} & set(sys.modules)",
+    ])
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert proc.stdout == "3\n"
+
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        _, cumulative_us, name = line.split("|")
+        if cumulative_us.strip().isdigit():
+            cumulative[name.strip()] = int(cumulative_us)
+    assert cumulative['mach'] < IMPORT_BUDGET_US
+
+
+def test_benchmarks():
+    from benchmarks import run
+
+    results = run(['parse_docs', 'onecmd', 'build_parsers'], quick=True)
+    assert {r['benchmark'] for r in results} == {
+        'parse_docs_long', 'onecmd', 'build_parsers'}
+    assert all(r['seconds'] > 0 for r in results)
+
+
+@mach.mach2()
+class Collector:
+
+    def many(self, first: int, *rest):
+        """collect the values"""
+        print(first + 1, rest)
+
+
+def test_shell_varargs():
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        Collector(stdout=StringIO()).onecmd('many 1 2 3')
+    assert fakeOutput.getvalue() == "2 ('2', '3')\n"
+
+
+@mach.mach2()
+class English:
+
+    def hello(self, name: str):
+        """greet in English"""
+        print("hello", name)
+
+
+@mach.mach2()
+class Counting:
+
+    def hello(self, times: int, loud: bool=False):
+        """greet many times"""
+        print("hello " * times)
+
+
+def test_shell_commands_per_class():
+    english, counting = English(stdout=StringIO()), Counting(stdout=StringIO())
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        english.onecmd('hello oz')
+        counting.onecmd('hello 2')
+    assert fakeOutput.getvalue() == "hello oz\nhello hello \n"
+    assert type(english)._commands is not type(counting)._commands
+    assert english.complete_hello("l", "hello l", 6, 7) == []
+    assert counting.complete_hello("l", "hello l", 6, 7) == ["loud="]
+
+
+@mach.mach2(timings=True)
+class Timed:
+
+    def add(self, a: int, b: int):
+        """add two numbers"""
+        print(a + b)
+
+
+def test_timings():
+    mach.clear_cache(Timed)
+    timed = Timed()
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput, \
+            mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        timed._run1(['--timings', 'add', '1', '2'])
+        assert fakeOutput.getvalue() == "3\n"
+        report = fakeError.getvalue()
+
+    assert report.startswith("timings: build ")
+    for phase in ('parse', 'execute'):
+        assert ", %s " % phase in report
+    assert "convert" not in report
+
+    # the class was built for the first run only
+    with mock.patch('sys.stdout', new=StringIO()), \
+            mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        Timed()._run1(['--timings', 'add', '1', '2'])
+        assert fakeError.getvalue().startswith("timings: parse ")
+
+    timed._timings = True
+    with mock.patch('sys.stdout', new=StringIO()), \
+            mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        timed.onecmd('add 1 2')
+        assert fakeError.getvalue().startswith("timings: parse ")
+
+
+def test_profile(tmpdir):
+    import pstats
+
+    stats = str(tmpdir.join("add.pstats"))
+    with mock.patch('sys.stdout', new=StringIO()):
+        Timed()._run1(['--profile', stats, 'add', '1', '2'])
+    functions = [func for _, _, func in pstats.Stats(stats).stats]
+    assert 'add' in functions
+
+
+@mach.mach2()
+class AsyncClient:
+
+    async def connect(self, host: str):
+        """open a session"""
+        import asyncio
+        self.session = asyncio.Queue()
+        await self.session.put(host)
+        self.stdout.write("Connected to %s\n" % host)
+
+    async def host(self):
+        """show the host of the session"""
+        self.stdout.write("Host is %s\n" % await self.session.get())
+
+
+@mach.mach1()
+class AsyncCalc:
+
+    async def add(self, a: int, b: int):
+        """adds two numbers"""
+        import asyncio
+        await asyncio.sleep(0)
+        print(a + b)
+
+
+def test_async_shell():
+    client = AsyncClient(stdout=StringIO())
+    client.onecmd('connect ftp.example.com')
+    loop = client._loop
+    # the queue is bound to the loop of the first command
+    client.onecmd('host')
+    assert client._loop is loop
+    assert client.stdout.getvalue() == (
+        "Connected to ftp.example.com\nHost is ftp.example.com\n")
+
+    client._close_loop()
+    assert loop.is_closed()
+
+    client = AsyncClient(stdout=StringIO())
+    failures = client.run_batch(['connect foo', 'host'])
+    assert not failures
+    assert client.stdout.getvalue().endswith("Host is foo\n")
+
+
+def test_async_run1():
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        AsyncCalc().run(['add', '1', '2'])
+        assert fakeOutput.getvalue() == "3\n"
+
+    client = AsyncClient(stdout=StringIO())
+    client._run1(['connect', 'foo'])
+    assert client.stdout.getvalue() == "Connected to foo\n"
+    assert '_loop' not in client.__dict__
+
+
+@mach.mach2(fan_out=True)
+class Pinger:
+
+    def ping(self, host: str, count: int=1):
+        """ping a host"""
+        import time
+        if host == "down":
+            raise ConnectionError("%s is down" % host)
+        time.sleep(0.01 if host == "slow" else 0)
+        print("%s %d" % (host, count))
+
+    def echo(self, word: str):
+        """write a word to the shell output"""
+        self.stdout.write(word + "\n")
+
+
+@pytest.mark.parametrize("unordered", [False, True])
+def test_fan_out(tmpdir, unordered):
+    hosts = tmpdir.join("hosts")
+    hosts.write("slow\na\n# comment\nb --count 3\n")
+    argv = ["--map", str(hosts), "--jobs", "3", "ping", "--count", "2"]
+    if unordered:
+        argv.append("--unordered")
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        assert Pinger()._run1(argv)
+        lines = fakeOutput.getvalue().splitlines()
+
+    if unordered:
+        assert sorted(lines) == ["a 2", "b 3", "slow 2"]
+    else:
+        assert lines == ["slow 2", "a 2", "b 3"]
+
+
+def test_fan_out_errors(tmpdir):
+    hosts = tmpdir.join("hosts")
+    hosts.write("a\ndown\na b c\n")
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput, \
+            mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        with pytest.raises(SystemExit):
+            Pinger()._run1(["--map", str(hosts), "ping"])
+        assert fakeOutput.getvalue() == "a 1\n"
+        errors = fakeError.getvalue()
+
+    assert "line 2: down: ConnectionError: down is down" in errors
+    assert "line 3: a b c: invalid arguments" in errors
+    assert errors.endswith("2 of 3 runs failed\n")
+
+
+@pytest.mark.parametrize("jobs", ["0", "-2", "x"])
+def test_fan_out_jobs(tmpdir, jobs):
+    hosts = tmpdir.join("hosts")
+    hosts.write("a\n")
+    with mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        with pytest.raises(SystemExit) as exit:
+            Pinger()._run1(["--map", str(hosts), "--jobs", jobs, "ping"])
+    assert exit.value.code == 2
+    assert "is not a positive integer" in fakeError.getvalue()
+
+
+def test_fan_out_shell_output(tmpdir):
+    words = tmpdir.join("words")
+    words.write("one\ntwo\n")
+    out = StringIO()
+    with mock.patch('sys.stdout', new=out):
+        pinger = Pinger()
+        pinger._run1(["--map", str(words), "echo"])
+    assert out.getvalue() == "one\ntwo\n"
+    assert pinger.stdout is out
+
+
+@mach.mach1(daemon=True, timings=True, metrics=True)
+class Daemonized:
+
+    def add(self, a: int, b: int):
+        """adds two numbers"""
+        print(a + b)
+
+    def fail(self, code: int):
+        """exit with an error"""
+        sys.stderr.write("failing\n")
+        sys.exit(code)
+
+    def wait(self, seconds: float):
+        """sleep and report"""
+        import time
+        time.sleep(seconds)
+        print("waited %s" % seconds)
+
+
+@mach.mach2(daemon=True)
+class AsyncDaemonized:
+
+    async def nap(self, seconds: float):
+        """sleep in the event loop"""
+        import asyncio
+        await asyncio.sleep(seconds)
+        print("slept %s" % seconds)
+
+
+def test_daemon_async(tmpdir):
+    import threading
+
+    path = str(tmpdir.join("sock"))
+    shell = AsyncDaemonized(stdout=StringIO())
+    daemon = threading.Thread(
+        target=shell._run1, args=(["--serve", path, "--idle-timeout", "0.5"],))
+    daemon.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        daemon.join(0.01)
+
+    results = {}
+
+    def call(seconds):
+        with mock.patch('sys.stdout', new=StringIO()):
+            results[seconds] = mach.client(path, ["nap", seconds])
+
+    clients = [threading.Thread(target=call, args=(s,))
+               for s in ("0.3", "0.2", "0.1")]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    assert results == {"0.3": 0, "0.2": 0, "0.1": 0}
+    daemon.join(5)
+    assert not daemon.is_alive()
+
+
+def test_daemon(tmpdir):
+    import threading
+
+    path = str(tmpdir.join("sock"))
+    daemon = threading.Thread(
+        target=Daemonized().run,
+        args=(["--serve", path, "--idle-timeout", "0.5"],))
+    daemon.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        daemon.join(0.01)
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        assert mach.client(path, ["add", "1", "2"]) == 0
+        assert fakeOutput.getvalue() == "3\n"
+
+    with mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        assert mach.client(path, ["fail", "3"]) == 3
+        assert mach.client(path, ["add", "x", "2"]) == 2
+        assert fakeError.getvalue().startswith("failing\nusage:")
+
+    # clients are served concurrently
+    results = {}
+
+    def call(seconds):
+        with mock.patch('sys.stdout', new=StringIO()):
+            results[seconds] = mach.client(path, ["wait", seconds])
+
+    clients = [threading.Thread(target=call, args=(s,))
+               for s in ("0.2", "0.1")]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    assert results == {"0.2": 0, "0.1": 0}
+
+    # the options of a request apply to that request only
+    with mock.patch('sys.stdout', new=StringIO()), \
+            mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        assert mach.client(path, ["--timings", "add", "1", "2"]) == 0
+        assert mach.client(path, ["add", "1", "2"]) == 0
+    assert fakeError.getvalue().count("timings: ") == 1
+
+    with mock.patch('sys.stderr', new=StringIO()) as fakeError:
+        argv = ["--serve", path + "2", "add", "1", "2"]
+        assert mach.client(path, argv) == 2
+    assert "--serve can not be run by a daemon" in fakeError.getvalue()
+    with mock.patch('sys.stderr', new=StringIO()) as fakeError, \
+            mock.patch('atexit.register') as register:
+        argv = ["--metrics", str(tmpdir.join("m.json")), "add", "1", "2"]
+        assert mach.client(path, argv) == 2
+    assert "--metrics can not be run by a daemon" in fakeError.getvalue()
+    assert not register.called
+    assert not os.path.exists(path + "2")
+
+    daemon.join(5)
+    assert not daemon.is_alive()
+    assert not os.path.exists(path)
+
+
+@mach.mach2()
+class Rows:
+
+    def rows(self, count: int):
+        """yield count rows"""
+        return ("row %d" % i for i in range(count))
+
+    def names(self):
+        """return a list"""
+        return ["foo", "bar"]
+
+    def title(self):
+        """strings are not streamed"""
+        return "title"
+
+    async def pages(self, count: int):
+        """yield pages asynchronously"""
+        for i in range(count):
+            yield "page %d" % i
+
+
+def test_stream_items():
+    rows = Rows(stdout=StringIO())
+    assert rows.onecmd("rows 3000") is None
+    lines = rows.stdout.getvalue().splitlines()
+    assert lines[0] == "row 0" and lines[-1] == "row 2999"
+    assert len(lines) == 3000
+
+    rows = Rows(stdout=StringIO())
+    assert rows.onecmd("names") is None
+    assert rows.onecmd("title") == "title"
+    rows.onecmd("pages 2")
+    assert rows.stdout.getvalue() == "foo\nbar\npage 0\npage 1\n"
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        Rows()._run1(["rows", "2"])
+        assert fakeOutput.getvalue() == "row 0\nrow 1\n"
+
+
+def test_stream_flush_policy():
+    stdout = mock.Mock()
+    rows = Rows(stdout=stdout)
+    rows.onecmd("rows 2500")
+    assert stdout.write.call_count == 3
+    assert not stdout.flush.called
+
+    stdout = mock.Mock()
+    rows = Rows(stdout=stdout)
+    rows.flush_every = 10
+    rows.onecmd("rows 25")
+    assert stdout.write.call_count == 3
+    assert stdout.flush.call_count == 3
+
+
+@mach.mach1(jsonl=True)
+class Service:
+
+    def add(self, a: int, b: int):
+        """adds two numbers"""
+        return a + b
+
+    def connect(self, host: str, port: int=21, **opts):
+        """connect to a host"""
+        print("connecting")
+        return {'host': host, 'port': port, 'opts': opts}
+
+    def rows(self, count: int):
+        """yield rows"""
+        return (i for i in range(count))
+
+
+def test_jsonl():
+    import json
+
+    requests = [
+        {"id": 1, "cmd": "add", "args": ["1", 2]},
+        {"cmd": "connect", "args": ["foo"],
+         "kwargs": {"port": "2121", "opts": {"user": "oz123"}}},
+        {"cmd": "rows", "args": [3]},
+        {"cmd": "connect", "kwargs": {"foo": 1}},
+        {"cmd": "add", "args": [1, 2, 3]},
+        {"cmd": "moo"},
+    ]
+    lines = [json.dumps(r) for r in requests] + ["", "{not json"]
+    out = StringIO()
+
+    assert mach.run_jsonl(Service(), lines, out) == 4
+    responses = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert responses[0] == {"id": 1, "result": 3}
+    assert responses[1] == {
+        "result": {"host": "foo", "port": 2121, "opts": {"user": "oz123"}},
+        "output": "connecting\n"}
+    assert responses[2] == {"result": [0, 1, 2]}
+    assert responses[3]["error"] == {"type": "TypeError",
+                                     "message": "Unknown option foo"}
+    assert responses[4]["error"]["type"] == "TypeError"
+    assert responses[5]["error"] == {"type": "LookupError",
+                                     "message": "Unknown command moo"}
+    assert responses[6]["error"]["type"] == "JSONDecodeError"
+
+
+def test_jsonl_unknown_requests():
+    import json
+
+    ftpc = FTPClient(stdout=StringIO())
+    ftpc.onecmd("help")
+    out = StringIO()
+    requests = [{"cmd": "help"}, {"cmd": "ls", "args": "12"},
+                {"cmd": "ls", "kwargs": ["/pub"]}, {"cmd": ["ls"]}]
+    assert mach.run_jsonl(ftpc, [json.dumps(r) for r in requests], out) == 4
+    errors = [json.loads(line)["error"]
+              for line in out.getvalue().splitlines()]
+    assert errors == [
+        {"type": "LookupError", "message": "Unknown command help"},
+        {"type": "TypeError", "message": "args must be an array"},
+        {"type": "TypeError", "message": "kwargs must be an object"},
+        {"type": "LookupError", "message": "Unknown command ['ls']"}]
+
+    out = StringIO()
+    assert mach.run_jsonl(Tool(), ['{"cmd": "db"}'], out) == 1
+    assert json.loads(out.getvalue())["error"] == {
+        "type": "LookupError", "message": "Unknown command db"}
+
+
+def test_jsonl_option():
+    stdin = StringIO('{"cmd": "add", "args": [1, 2]}\n')
+    with mock.patch('sys.stdin', new=stdin), \
+            mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        assert Service().run(["--jsonl"])
+        assert fakeOutput.getvalue() == '{"result": 3}\n'
+
+    ftpc = FTPClient(stdout=StringIO())
+    out = StringIO()
+    mach.run_jsonl(ftpc, ['{"cmd": "ls", "args": ["/pub"]}'], out)
+    assert out.getvalue() == '{"result": null, "output": "Files in /pub\\n"}\n'
+    assert ftpc.stdout.getvalue() == ""
+
+
+@mach.mach1(completion=True)
+class Completed:
+
+    def add(self, a: int, b: int=1):
+        """adds two numbers"""
+
+    def sub(self, a: int, verbose: bool=False):
+        """subtracts one"""
+
+
+def complete_words(script, *words):
+    line = " ".join(("completed",) + words)
+    out = subprocess.run(
+        ["bash", "-c", script + '\nCOMP_WORDS=(%s)\nCOMP_CWORD=%d\n'
+         '_mach_completed\necho "${COMPREPLY[@]}"' % (line, len(words))],
+        capture_output=True, text=True, check=True).stdout
+    return out.split()
+
+
+@pytest.mark.skipif(not os.path.exists("/bin/bash"), reason="needs bash")
+def test_completion_bash():
+    script = mach.completion_script(Completed().parser, "bash", "completed")
+
+    assert complete_words(script, "") == [
+        "-h", "--help", "--completion", "add", "sub"]
+    assert complete_words(script, "s") == ["sub"]
+    assert complete_words(script, "sub", "--") == ["--help", "--verbose"]
+    assert complete_words(script, "--completion", "z") == ["zsh"]
+
+
+def test_completion_option(tmpdir):
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        assert Completed().run(["--completion", "zsh"])
+    script = fakeOutput.getvalue()
+    assert script.startswith("#compdef")
+    assert "(sub) compadd -- -h --help --verbose -v;;" in script
+
+    fish = mach.completion_script(Completed().parser, "fish", "completed")
+    assert ("complete -c completed -n '__fish_seen_subcommand_from add' "
+            "-s b -r -F") in fish
+
+    @mach.mach1(spec_cache=str(tmpdir), completion=True)
+    class Cached:
+
+        def add(self, a: int):
+            """adds"""
+
+    with mock.patch('sys.stdout', new=StringIO()):
+        Cached().run(["--completion", "bash"])
+    saved = [p for p in tmpdir.listdir() if p.ext == ".bash"]
+    assert len(saved) == 1 and "add" in saved[0].read()
+
+
+def test_shell_completion():
+    ftpc = FTPClient(stdout=StringIO())
+
+    assert ftpc.completenames("l") == ["login", "ls"]
+    assert ftpc.completenames("") == sorted(ftpc.completenames(""))
+    assert "help" in ftpc.completenames("")
+    line = "connect foo "
+    assert ftpc.complete_connect("", line, len(line), len(line)) == [
+        "host=", "opts=", "port="]
+    line = "connect host=foo "
+    assert ftpc.complete_connect("", line, len(line), len(line)) == [
+        "opts=", "port="]
+    assert ftpc.complete_connect("p", "connect p", 8, 9) == ["port="]
+    assert ftpc.complete_ls("x", "ls x", 3, 4) == []
+
+
+def test_parse_docs():
+    doc = mach.parse_docs(
+        "connect to a host\n\nhost - the host IP\n  or fqdn\n"
+        "\nthis line - is not an argument\n---\nlonger help")
+    assert doc == {'cmd': 'connect to a host\nlonger help',
+                   'host': 'the host IP or fqdn'}
+
+    google = inspect.cleandoc("""Connect to a host.
+
+        Args:
+            host (str): the host IP
+                or fqdn.
+            **opts: passed to the client
+
+        Returns:
+            port: not an argument
+        """)
+    assert mach.parse_docs(google) == {
+        'cmd': 'Connect to a host.', 'host': 'the host IP or fqdn.',
+        'opts': 'passed to the client'}
+
+    numpy = inspect.cleandoc("""Connect to a host.
+
+        Parameters
+        ----------
+        host : str
+            the host IP
+        port : int
+
+        Returns
+        -------
+        int
+            not an argument
+        """)
+    assert mach.parse_docs(numpy) == {
+        'cmd': 'Connect to a host.', 'host': 'the host IP', 'port': ''}
+
+
+def test_function_docs_memoised():
+    def connect(self, host):
+        """connect
+
+        host - the host
+        """
+
+    docstring, doc = mach.function_docs(connect)
+    with mock.patch('mach.parse_docs') as parse:
+        assert mach.function_docs(connect)[1] is doc
+        connect.__doc__ = "moo"
+        mach.function_docs(connect)
+    assert parse.call_count == 1
+
+
+def test_function_docs_collected():
+    import gc
+    import weakref
+
+    kls = type('Temporary', (), {'run': lambda self: None})
+    mach.function_docs(kls.run)
+    ref = weakref.ref(kls.run)
+    del kls
+    gc.collect()
+    assert ref() is None
+    assert mach.function_docs(len)[1]['cmd']
+
+
+@mach.mach1()
+class Tool:
+
+    groups = {'db': ('examples.tool_db.Database', 'manage the database')}
+
+    def version(self):
+        """show the version"""
+        print("0.1")
+
+
+def test_command_groups():
+    sys.modules.pop('examples.tool_db', None)
+    mach.clear_cache(Tool)
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        Tool().run(["version"])
+    assert fakeOutput.getvalue() == "0.1\n"
+    assert "manage the database" in Tool().parser.format_help()
+    assert 'examples.tool_db' not in sys.modules
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        Tool().run(["db", "migrate", "3"])
+        Tool().run(["db", "schema", "show", "users"])
+        Tool().run(["db"])
+    output = fakeOutput.getvalue().splitlines()
+    assert output[:2] == ["migrating to version 3", "CREATE TABLE users (...)"]
+    assert output[2].endswith(" db [-h] {migrate,schema} ...")
+
+
+class Inbox:
+
+    default = 'unread'
+
+    def unread(self, limit: int=10):
+        """count the unread messages"""
+        print("unread %d" % limit)
+
+    def read(self, message: int):
+        """read a message"""
+        print("read %d" % message)
+
+
+@mach.mach1(timings=True)
+class Mail:
+
+    default = 'send'
+    groups = {'inbox': __name__ + '.Inbox'}
+
+    def send(self, to: str="all"):
+        """send the mail"""
+        print("send to %s" % to)
+
+
+@pytest.mark.parametrize("argv, expected", [
+    ([], "send to all"),
+    (["--to", "inbox"], "send to inbox"),
+    (["--to=inbox"], "send to inbox"),
+    (["send", "--to", "oz"], "send to oz"),
+    (["--timings"], "send to all"),
+    (["--timings", "--to", "oz"], "send to oz"),
+    (["--timings", "send"], "send to all"),
+    (["inbox"], "unread 10"),
+    (["--timings", "inbox", "--limit", "3"], "unread 3"),
+    (["inbox", "read", "2"], "read 2"),
+])
+def test_default_subcommands(argv, expected):
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput, \
+            mock.patch('sys.stderr', new=StringIO()):
+        Mail().run(argv)
+    assert fakeOutput.getvalue() == expected + "\n"
+
+
+def test_default_subcommand_help():
+    parser = Mail().parser
+    for argv in (["-h"], ["--timings", "--help"]):
+        with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+            with pytest.raises(SystemExit):
+                parser.parse_args(argv)
+        assert "{send,inbox}" in fakeOutput.getvalue()
+    assert parser._default_index(["--timings", "inbox"]) is None
+    assert parser._default_index(["--timings", "--to", "inbox"]) == 1
+
+
+lookups = []
+
+
+@mach.mach2()
+class Lookup:
+
+    @mach.memoize(ttl=60)
+    def owner(self, host: str, port: int=21):
+        """find the owner of a host"""
+        lookups.append(host)
+        return "%s:%d" % (host, port)
+
+
+def test_memoize_shell():
+    shell = Lookup(stdout=StringIO())
+    del lookups[:]
+    with mock.patch('sys.stdout', new=StringIO()):
+        shell.onecmd("owner foo")
+        shell.onecmd("owner host=foo port=21")
+        shell.onecmd("owner foo port=2121")
+        assert len(lookups) == 2
+
+        stamp, _ = next(iter(type(shell).owner.memo.lru.values()))
+        with mock.patch('time.time', return_value=stamp + 61):
+            shell.onecmd("owner foo")
+    assert len(lookups) == 3
+
+
+def test_memoize_threads():
+    shell = Lookup(stdout=StringIO())
+    memo = mach._Memo(Lookup.__wrapped__.owner, None, 2, None, None)
+    errors = []
+
+    def use(n):
+        try:
+            for i in range(2000):
+                key = str((n + i) % 5)
+                memo.put(shell, key, i)
+                memo.get(shell, key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=use, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(memo.lru) == 2
+
+
+def test_memoize_store(tmpdir):
+    calls = []
+
+    @mach.mach1()
+    class Rates:
+
+        @mach.memoize(store=str(tmpdir), max_bytes=1000)
+        def rate(self, currency: str):
+            """look up a rate"""
+            calls.append(currency)
+            return {'currency': currency, 'rate': 1.5}
+
+    for argv in (["rate", "EUR"], ["rate", "EUR"], ["rate", "USD"]):
+        Rates().run(argv)
+    assert calls == ["EUR", "USD"]
+    assert len(tmpdir.listdir()) == 2
+    assert Rates().rate("EUR") == {'currency': 'EUR', 'rate': 1.5}
+
+    Rates.__wrapped__.rate.memo.max_bytes = 0
+    Rates().rate("GBP")
+    assert tmpdir.listdir() == []
+
+
+def test_command_spec_shared():
+    mach.clear_cache(Calc2)
+    getfullargspec = inspect.getfullargspec
+    with mock.patch('inspect.getfullargspec',
+                    side_effect=getfullargspec) as inspected, \
+            mock.patch('sys.stdout', new=StringIO()):
+        calc = Calc2(stdout=StringIO())
+        calc._run1(["add", "1", "2"])
+        calc.onecmd("add 1 2")
+        calc._run1(["add", "3", "4"])
+    assert inspected.call_count == 1
+
+    spec = type(calc)._commands['add']
+    assert isinstance(spec, mach.CommandSpec)
+    assert spec.args == ('a', 'b') and spec.converters == {'a': int, 'b': int}
+    assert not hasattr(spec, '__dict__')
+    with pytest.raises(AttributeError):
+        spec.args = ()
+
+
+@mach.mach2()
+class Stats:
+
+    def mean(self, values: List[float]):
+        """the mean of the values"""
+        return values
+
+    def point(self, xy: Tuple[int, float], scale: List[int]=()):
+        """move a point"""
+        return xy, scale
+
+
+def test_sequence_type_typing_origin():
+    import types
+    # List[int].__origin__ is typing.List before Python 3.7
+    typing_list = type('List', (), {'__module__': 'typing'})
+    typing_tuple = type('Tuple', (), {'__module__': 'typing'})
+    assert mach.sequence_type(types.SimpleNamespace(
+        __origin__=typing_list, __args__=(int,))) == \
+        mach.SequenceSpec('list', ('int',), True)
+    assert mach.sequence_type(types.SimpleNamespace(
+        __origin__=typing_tuple, __args__=(int, float))) == \
+        mach.SequenceSpec('tuple', ('int', 'float'), False)
+    assert mach.sequence_type(types.SimpleNamespace(
+        __origin__=type('List', (), {}), __args__=(int,))) is None
+
+
+def test_sequence_arguments():
+    stats = Stats(stdout=StringIO())
+    p = stats.parser.parse_args(["mean"] + [str(i) for i in range(100000)])
+    assert len(p.values) == 100000 and p.values[-1] == 99999.0
+    assert not isinstance(p.values, list)
+
+    p = stats.parser.parse_args(["point", "1", "2.5", "--scale", "3", "4"])
+    assert p.xy == (1, 2.5) and list(p.scale) == [3, 4]
+    with mock.patch('sys.stderr', new=StringIO()) as err, \
+            pytest.raises(SystemExit):
+        stats.parser.parse_args(["mean", "1", "x"])
+    assert "invalid list[float] value" in err.getvalue()
+
+    spec = mach.command_spec(type(stats), 'point')
+    assert spec.converters['scale']("1,2 3").tolist() == [1, 2, 3]
+    assert spec.converters['xy']("1 2") == (1, 2.0)
+
+
+def test_sequence_spec_cache():
+    sequence = mach.sequence_type(Tuple[int, ...])
+    assert mach.sequence_name(sequence) == "tuple[int, ...]"
+    assert mach.parse_sequence_name("tuple[int, ...]") == sequence
+    assert mach.parse_sequence_name("tuple[int, float]") == \
+        mach.sequence_type(Tuple[int, float])
+    assert mach.sequence_type(List[dict]) is None
+
+
+@mach.mach1(args_file=True)
+class Loader:
+
+    def total(self, values: List[int], scale: int=1):
+        """add the values"""
+        print(sum(values) * scale)
+
+    def size(self, data: bytes):
+        """count the bytes of a file"""
+        print(type(data).__name__, len(data), bytes(data[:5]))
+
+
+def test_args_file(tmpdir):
+    values = tmpdir.join("values")
+    values.write("\n".join(str(i) for i in range(100000)) + "\n")
+    options = tmpdir.join("options")
+    options.write("--scale\r\n2\n@%s" % values)
+
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        Loader().run(["total", "@%s" % values])
+        Loader().run(["total", "@%s" % options])
+        Loader().run(["size", str(values)])
+    assert fakeOutput.getvalue().splitlines() == [
+        str(sum(range(100000))), str(2 * sum(range(100000))),
+        "memoryview %d b'0\\n1\\n2'" % values.size()]
+
+    with mock.patch('sys.stderr', new=StringIO()), \
+            pytest.raises(SystemExit):
+        Loader().run(["total", "@%s" % tmpdir.join("missing")])
+
+
+release = threading.Event()
+
+
+@mach.mach2()
+class Worker:
+
+    def slow(self, name: str):
+        """wait until released and print the name"""
+        release.wait(5)
+        print("slow", name)
+
+    def fail(self):
+        """raise an error"""
+        raise RuntimeError("boom")
+
+
+def test_background_jobs():
+    shell = Worker(stdout=StringIO())
+    shell.max_jobs = 1
+    stdout = sys.stdout
+    shell.onecmd("slow a &")
+    shell.onecmd("slow b &")
+    shell.onecmd("fail &")
+    shell.onecmd("cancel 2")
+    while not shell._jobs.jobs[1].future.running():
+        time.sleep(0.01)
+    shell.onecmd("jobs")
+    assert sys.stdout is not stdout
+    assert shell.stdout.stream.getvalue().splitlines() == [
+        "[1] slow a", "[2] slow b", "[3] fail", "[2] cancelled slow b",
+        "[1] running   slow a", "[3] queued    fail"]
+
+    release.set()
+    shell.stdout.stream.truncate(0)
+    shell.stdout.stream.seek(0)
+    shell.onecmd("wait")
+    shell.onecmd("wait 1")
+    assert shell.stdout.stream.getvalue().splitlines() == [
+        "slow a", "[3] failed: boom", "No job 1"]
+    shell._close_jobs()
+    assert sys.stdout is stdout
+
+
+def test_background_jobs_errors():
+    release.set()
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        shell = Worker(stdout=fakeOutput)
+        failures = shell.run_batch(["bad x &", "slow a", "slow b"])
+    assert failures == []
+    output = fakeOutput.getvalue().splitlines()
+    assert "slow a" in output and "slow b" in output
+    assert "[1] failed    bad x" in output
+    assert "[1] failed: Unknown syntax" in output
+    assert shell.lasterror is None
+
+
+def test_background_jobs_batch():
+    release.set()
+    with mock.patch('sys.stdout', new=StringIO()) as fakeOutput:
+        shell = Worker(stdout=fakeOutput)
+        failures = shell.run_batch(["slow a &", "slow b"])
+        assert sys.stdout is fakeOutput
+        assert shell.stdout is fakeOutput
+    assert failures == []
+    output = fakeOutput.getvalue().splitlines()
+    assert output[0] == "[1] slow a"
+    assert sorted(output[1:]) == ["[1] done      slow a", "slow a", "slow b"]
+
+
+@mach.mach2(metrics=True)
+class Metered:
+
+    def add(self, a: int, b: int):
+        """adds two numbers"""
+        print(a + b)
+
+    def fail(self):
+        """always fails"""
+        raise RuntimeError("boom")
+
+
+def test_metrics(tmpdir):
+    shell = Metered(stdout=StringIO())
+    with mock.patch('sys.stdout', new=StringIO()):
+        shell.onecmd("add 1 2")
+        shell.onecmd("add 3 4")
+        with pytest.raises(RuntimeError):
+            shell.onecmd("fail")
+        shell.onecmd("stats")
+
+    table = shell.stdout.getvalue().splitlines()
+    assert table[0].split() == ["command", "calls", "errors", "mean", "ms",
+                                "p95", "ms"]
+    assert table[1].split()[:3] == ["add", "2", "0"]
+    assert table[2].split()[:3] == ["fail", "1", "1"]
+
+    metrics = shell._metrics.to_json()
+    assert metrics['add']['buckets']['+Inf'] == 2
+    text = shell._metrics.to_prometheus()
+    assert 'mach_command_errors_total{command="fail"} 1' in text
+    assert 'mach_command_duration_seconds_count{command="add"} 2' in text
+
+    path = str(tmpdir.join("metrics.json"))
+    with mock.patch('atexit.register') as register, \
+            mock.patch('sys.stdout', new=StringIO()):
+        shell._run1(["--metrics", path, "add", "5", "6"])
+    register.assert_called_once_with(shell._metrics.write, path)
+    shell._metrics.write(path)
+    import json
+    with open(path) as f:
+        assert json.load(f)['add']['count'] == 3
+
+
+@mach.mach2(explicit=True, metrics=True)
+class MeteredTool:
+
+    def add(self, a: int, b: int):
+        """adds two numbers"""
+        print(a + b)
+
+
+def test_metrics_shell(tmpdir):
+    shell = MeteredTool(stdout=StringIO())
+    path = str(tmpdir.join("shell.prom"))
+    with mock.patch('atexit.register') as register, \
+            mock.patch.object(shell, 'cmdloop') as cmdloop:
+        shell._run1(["--metrics", path, "--shell"])
+    cmdloop.assert_called_once_with()
+    register.assert_called_once_with(shell._metrics.write, path)
+
+
+def test_replace_file(tmpdir):
+    path = str(tmpdir.join("out", "metrics.prom"))
+    mach._replace_file(path, lambda f: f.write("first\n"))
+
+    def fail(f):
+        f.write("partial")
+        raise ValueError("interrupted")
+
+    with pytest.raises(ValueError):
+        mach._replace_file(path, fail)
+    assert tmpdir.join("out").listdir() == [tmpdir.join("out", "metrics.prom")]
+    assert tmpdir.join("out", "metrics.prom").read() == "first\n"
+
+
+@pytest.mark.parametrize("kls, argv", [
+    (Calculator, ["add", "2", "4"]),
+    (Calculator, ["div", "8", "2"]),
+    (uFTPD, ["server"]),
+    (uFTPD, ["server", "--level", "3", "-f", "--syslog"]),
+    (uFTPD, ["server", "-l", "3", "-v", "--opts", '{"ftp": 21}']),
+    (FTPClient, ["ls"]),
+    (FTPClient, ["login", "oz123", ""]),
+    (Pinger, ["ping", "--count", "3", "example.com"]),
+    (Timed, ["add", "1", "2"]),
+])
+def test_fast_parse(kls, argv):
+    parser = kls().parser
+    fast = mach._fast_parse(parser, argv)
+    assert fast is not None
+    assert vars(fast) == vars(parser.parse_args(argv))
+
+
+def test_fast_parse_permutations():
+    import itertools
+
+    parser = FTPClient().parser
+    pieces = [["--port", "2121"], ["-p", "21"], ["--opts", '{"user": "oz"}']]
+    for count in range(len(pieces) + 1):
+        for options in itertools.permutations(pieces, count):
+            for at in range(count + 1):
+                tokens = list(itertools.chain(*options))
+                argv = ["connect"] + tokens[:2 * at] + ["foo"] + \
+                    tokens[2 * at:]
+                fast = mach._fast_parse(parser, argv)
+                assert vars(fast) == vars(parser.parse_args(argv)), argv
+
+
+@pytest.mark.parametrize("argv", [
+    [], ["--shell"], ["add"], ["add", "2"], ["add", "2", "4", "5"],
+    ["add", "x", "4"], ["add", "", "4"], ["add", "2", "4", "--help"],
+    ["add", "-h"], ["add", "-2", "4"], ["add", "--", "2", "4"],
+    ["moo", "2", "4"],
+])
+def test_fast_parse_falls_back(argv):
+    assert mach._fast_parse(Calculator().parser, argv) is None
+
+
+def test_fast_parse_unsupported():
+    assert mach._fast_parse(FTPClient().parser,
+                            ["connect", "foo", "--port=21"]) is None
+    assert mach._fast_parse(FTPClient().parser,
+                            ["connect", "foo", "--po", "21"]) is None
+    assert mach._fast_parse(Stats().parser, ["mean", "1", "2"]) is None
+    assert mach._fast_parse(Loader().parser, ["size", "@file"]) is None